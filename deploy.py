@@ -1,10 +1,21 @@
+import hashlib
+import inspect
+import io
+import json
 import os
+from fnmatch import fnmatch
+from functools import cache
 from getpass import getuser
+from pathlib import Path
 
 from pyinfra import config, host
 from pyinfra.api import operation
 from pyinfra.facts.hardware import Ipv4Addresses
+from pyinfra.facts.server import Command
 from pyinfra.operations import files, pacman, pip, server, systemd
+from pyinfra.operations.util import any_changed
+
+import precompress
 
 # load .env
 with open(".env", "r") as fh:
@@ -17,19 +28,88 @@ with open(".env", "r") as fh:
 config.SUDO = True
 config.USE_SUDO_PASSWORD = env["SUDO_PASSWORD"]
 admin = getuser()
+# the telegram bot runs in two slots that take turns on deploys, see
+# telegram/handoff.py; slot: (local port of the webhook listener behind caddy,
+# metrics and health port)
+telegram_slots = {"blue": (8443, 9464), "green": (8444, 9465)}
+telegram_venv = f"/home/{admin}/.venv/telegram"
+telegram_exclude = ["*.pyc"]
+telegram_exclude_dir = ["db", "__pycache__", "*/__pycache__"]
+
+# A step only runs when its inputs or its own code changed since the last
+# deploy: their hash is noted on the server after the step and compared before
+# the next deploy.
+# FORCE=1 runs all steps, e.g. after changing the server by hand.
+deployed_dir = "/var/lib/deploy"
+force = os.environ.get("FORCE") == "1"
+
+
+def digest(*sources: str, step, exclude=(), exclude_dir=(), **values) -> str:
+    """sha256 of the files in `sources`, of the `values` they're rendered with
+    and of the source of the `step` function deploying them, excluding files
+    and directories like files.sync."""
+    sha = hashlib.sha256()
+    sha.update(inspect.getsource(step).encode() + b"\0")
+    for source in sources:
+        root = Path(source)
+        paths = [root] if root.is_file() else []
+        for dirpath, dirnames, filenames in os.walk(root):
+            relative = Path(dirpath).relative_to(root)
+            dirnames[:] = sorted(
+                name
+                for name in dirnames
+                if not any(
+                    fnmatch((relative / name).as_posix(), e) for e in exclude_dir
+                )
+            )
+            paths += [
+                Path(dirpath) / name
+                for name in sorted(filenames)
+                if not any(fnmatch(str(Path(dirpath) / name), e) for e in exclude)
+            ]
+        for path in paths:
+            sha.update(path.as_posix().encode() + b"\0" + path.read_bytes() + b"\0")
+    sha.update(repr(sorted(values.items())).encode())
+    return sha.hexdigest()
+
+
+@cache
+def deployed() -> dict[str, str]:
+    """The hashes noted by the last deploy, read in one go."""
+    output = host.get_fact(
+        Command, command=f"cat {deployed_dir}/*.sha256 2>/dev/null || true"
+    )
+    return dict(line.split() for line in (output or "").splitlines() if line)
+
+
+def changed(step: str, sha: str) -> bool:
+    return force or deployed().get(step) != sha
+
+
+def note(step: str, sha: str) -> None:
+    files.put(
+        name=f"Note the deployed {step}.",
+        src=io.StringIO(f"{step} {sha}\n"),
+        dest=f"{deployed_dir}/{step}.sha256",
+    )
 
 
 def base():
+    packages = [
+        "caddy",
+        "webhook",
+        "docker",
+        "python",
+        "ffmpeg",
+        "pacman-contrib",
+        "transmission-cli",
+    ]
+    sha = digest("bashrc", step=base, packages=packages, admin=admin)
+    if not changed("base", sha):
+        return
     pacman.packages(
         name="Install packages.",
-        packages=[
-            "caddy",
-            "webhook",
-            "docker",
-            "python",
-            "pacman-contrib",
-            "transmission-cli",
-        ],
+        packages=packages,
     )
 
     # .bashrc
@@ -40,29 +120,35 @@ def base():
         user=admin,
         groups=[admin, "sudo", "transmission"],
     )
+    note("base", sha)
 
 
 def caddy():
     # caddy
+    webhook_ports = [port for port, _ in telegram_slots.values()]
+    sha = digest("caddy", step=caddy, admin=admin, telegram_webhook_ports=webhook_ports)
+    if not changed("caddy", sha):
+        return
     server.user(
         name="Add caddy user, include in admin and transmission group.",
         user="caddy",
         groups=[admin, "transmission"],
     )
-    files.put(
+    caddyfile = files.template(
         name="Update Caddyfile.",
-        src="caddy/Caddyfile",
+        src="caddy/Caddyfile.j2",
         dest="/etc/caddy/Caddyfile",
         user="caddy",
         group="caddy",
         mode="644",
+        __telegram_webhook_ports=webhook_ports,
     )
     files.directory(
         name="Allow home-directory to group access (caddy is in admin group).",
         path=f"/home/{admin}",
         mode="750",
     )
-    files.put(
+    unit = files.put(
         name="Update file caddy.service.",
         src="caddy/caddy.service",
         dest="/etc/systemd/system/caddy.service",
@@ -70,24 +156,81 @@ def caddy():
         group="root",
         mode="644",
     )
+    systemd.daemon_reload(name="Reload systemd units.", _if=unit.did_change)
     systemd.service(
-        name="Reload caddy service.",
+        name="Start caddy service.",
         service="caddy.service",
         running=True,
         enabled=True,
+    )
+    systemd.service(
+        name="Reload caddy service.",
+        service="caddy.service",
         reloaded=True,
+        _if=any_changed(caddyfile, unit),
     )
+    note("caddy", sha)
 
 
 def filesharing():
-    # filesharing via caddy
-    files.sync(
+    # filesharing via caddy, with compressed copies and ETags next to the files,
+    # see precompress.py; only what changed since the last deploy is uploaded
+    # and files shared twice are linked, by what was noted on the server
+    manifest = precompress.build(Path("filesharing"))
+    shared = precompress.tree(manifest, Path("filesharing"))
+    deployed_tree = {path: [kind, key] for path, (kind, key, _) in shared.items()}
+    sha = digest(step=filesharing, admin=admin, tree=deployed_tree)
+    if not changed("filesharing", sha):
+        return
+    previous = json.loads(
+        host.get_fact(
+            Command,
+            command=f"cat {deployed_dir}/filesharing.json 2>/dev/null || echo {{}}",
+        )
+        or "{}"
+    )
+    root = f"/home/{admin}/filesharing"
+    files.directory(
         name="Create folder for filesharing.",
-        dest=f"/home/{admin}/filesharing",
-        src="filesharing",
+        path=root,
         user=admin,
         group=admin,
     )
+    for path, (kind, _) in sorted(previous.items()):
+        if path in deployed_tree and deployed_tree[path][0] == kind:
+            continue
+        # removed, or a file became a link or the other way round
+        remove = files.link if kind == "link" else files.file
+        remove(
+            name=f"Remove {path} from filesharing.",
+            path=f"{root}/{path}",
+            present=False,
+        )
+    for path, (kind, key, local) in sorted(shared.items()):
+        if previous.get(path) == [kind, key]:
+            continue
+        if kind == "link":
+            files.link(
+                name=f"Link {path} in filesharing.",
+                path=f"{root}/{path}",
+                target=key,
+                user=admin,
+                group=admin,
+            )
+        else:
+            files.put(
+                name=f"Upload {path} to filesharing.",
+                src=str(local) if local else io.StringIO(key),
+                dest=f"{root}/{path}",
+                user=admin,
+                group=admin,
+                mode="644",
+            )
+    files.put(
+        name="Note the shared files.",
+        src=io.StringIO(json.dumps(deployed_tree, indent=1, sort_keys=True)),
+        dest=f"{deployed_dir}/filesharing.json",
+    )
 
     # filesharing via torrent
     # https://wiki.archlinux.org/title/Transmission
@@ -131,12 +274,25 @@ def filesharing():
         path=f"/home/{admin}/filesharing/torrents",
         target="/var/lib/transmission/torrents",
     )
+    note("filesharing", sha)
 
 
 def webhooks():
     # webhooks
     # https://github.com/adnanh/webhook/blob/master/docs/Hook-Definition.md
-    files.template(
+    sha = digest("webhook", step=webhooks, admin=admin, env=env)
+    if not changed("webhooks", sha):
+        return
+    # pulls for the hooks, one at a time and once per burst of pushes
+    files.put(
+        name="Update webhook hook runner.",
+        src="webhook/hookrunner.py",
+        dest=f"/home/{admin}/webhook/hookrunner.py",
+        user=admin,
+        group=admin,
+        mode="755",
+    )
+    hooks = files.template(
         name="Update webhook config.",
         src="webhook/hooks.json.j2",
         dest="/etc/webhook/hooks.json",
@@ -147,45 +303,113 @@ def webhooks():
         __env=env,
     )
     systemd.service(
-        name="Update webhook service.",
+        name="Start webhook service.",
         service="webhook",
         running=True,
         enabled=True,
+    )
+    systemd.service(
+        name="Restart webhook service.",
+        service="webhook",
         restarted=True,
+        _if=hooks.did_change,
     )
+    note("webhooks", sha)
 
 
 def telegram():
     # telegram bot
-    files.template(
-        name="Update telegrambot service.",
-        src="telegram/telegrambot.service.j2",
-        dest="/etc/systemd/system/telegrambot.service",
-        user="root",
-        group="root",
-        mode="644",
-        __admin=admin,
+    units_sha = digest(
+        "telegram/telegrambot@.service.j2",
+        "telegram/slot.env.j2",
+        step=telegram,
+        admin=admin,
+        slots=telegram_slots,
     )
-    files.sync(
-        name="Copy folder for telegram.",
-        dest=f"/home/{admin}/telegram",
-        src="telegram",
-        exclude_dir=["db"],
+    code_sha = digest(
+        "telegram",
+        step=telegram,
+        exclude=telegram_exclude,
+        exclude_dir=telegram_exclude_dir,
     )
-    pip.packages(
-        name="Install Python packages from requirements.txt",
-        requirements=f"/home/{admin}/telegram/requirements.txt",
-        virtualenv=f"/home/{admin}/.venv/telegram",
-        virtualenv_kwargs={"venv": True},
-        present=True,
+    requirements_sha = digest(
+        "telegram/requirements.txt", step=telegram, venv=telegram_venv
     )
-    systemd.service(
-        name="Update telegrambot service.",
-        service="telegrambot",
-        running=True,
-        enabled=True,
-        restarted=True,
+    shas = {
+        "telegram-units": units_sha,
+        "telegram-code": code_sha,
+        "telegram-requirements": requirements_sha,
+    }
+    if not any(changed(step, sha) for step, sha in shas.items()):
+        return
+
+    if changed("telegram-units", units_sha):
+        unit = files.template(
+            name="Update telegrambot service.",
+            src="telegram/telegrambot@.service.j2",
+            dest="/etc/systemd/system/telegrambot@.service",
+            user="root",
+            group="root",
+            mode="644",
+            __admin=admin,
+        )
+        for slot, (webhook_port, metrics_port) in telegram_slots.items():
+            files.template(
+                name=f"Update telegrambot {slot} slot.",
+                src="telegram/slot.env.j2",
+                dest=f"/etc/telegrambot/{slot}.env",
+                user="root",
+                group="root",
+                mode="644",
+                __slot=slot,
+                __webhook_port=webhook_port,
+                __metrics_port=metrics_port,
+            )
+        systemd.daemon_reload(name="Reload systemd units.", _if=unit.did_change)
+        files.file(
+            name="Remove the telegrambot service from before the slots.",
+            path="/etc/systemd/system/telegrambot.service",
+            present=False,
+        )
+    if changed("telegram-code", code_sha):
+        files.sync(
+            name="Copy folder for telegram.",
+            dest=f"/home/{admin}/telegram",
+            src="telegram",
+            exclude=telegram_exclude,
+            exclude_dir=telegram_exclude_dir,
+        )
+    if changed("telegram-requirements", requirements_sha):
+        # the wheels are built once per change of the requirements and kept,
+        # installing them again doesn't need the network or a compiler
+        requirements = f"/home/{admin}/telegram/requirements.txt"
+        wheelhouse = f"/home/{admin}/.cache/telegram-wheels"
+        pip.virtualenv(name="Create venv for telegram.", path=telegram_venv, venv=True)
+        server.shell(
+            name="Build wheels from requirements.txt",
+            commands=[
+                f"{telegram_venv}/bin/pip wheel --quiet --wheel-dir {wheelhouse}"
+                f" -r {requirements}"
+            ],
+        )
+        pip.packages(
+            name="Install Python packages from requirements.txt",
+            requirements=requirements,
+            virtualenv=telegram_venv,
+            extra_install_args=f"--no-index --find-links {wheelhouse}",
+            present=True,
+        )
+    # starts the other slot and stops the running one once the new one is ready,
+    # instead of a restart that would drop the voice messages in processing
+    server.shell(
+        name="Hand the telegram bot over to a new instance.",
+        commands=[
+            f"python /home/{admin}/telegram/handoff.py "
+            + " ".join(f"{slot}={port}" for slot, (_, port) in telegram_slots.items())
+        ],
     )
+    for step, sha in shas.items():
+        note(step, sha)
 
 
 def nextcloud():
@@ -224,7 +448,7 @@ def nextcloud():
 
 
 tags = os.environ.get("TAGS", "base,caddy,filesharing,webhooks,telegram").split(",")
-print(f"Running tasks: {tags}")
+print(f"Running tasks: {tags}" + (", forced" if force else ""))
 for tag in tags:
     # run the function with the same name as the argument
     globals()[tag]()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Builds what deploy.py uploads to the filesharing folder: next to each shared
+# file a gzip and a zstd copy, if the file compresses, and an .etag file, which
+# caddy's file_server serves instead of compressing on the fly and instead of
+# an ETag from the modification time. The copies are kept in a cache by the
+# hash of the file, so a file is only compressed once however often it's
+# shared or renamed, and a manifest remembers the hashes by size and mtime, so
+# unchanged files aren't read again.
+#
+#   python precompress.py filesharing
+#
+# https://caddyserver.com/docs/caddyfile/directives/file_server
+# Needs zstd on PATH for the zstd copies.
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+    / "server-apps"
+    / "precompressed"
+)
+# the suffixes file_server's precompressed looks for, zstd and gzip
+SUFFIXES = ("zst", "gz")
+# formats that are compressed already
+INCOMPRESSIBLE = set(
+    ".7z .avif .br .bz2 .flac .gif .gz .jpeg .jpg .m4a .mkv .mov .mp3 .mp4 .ogg"
+    " .opus .png .rar .tgz .webm .webp .woff2 .xz .zip .zst".split()
+)
+# smaller files gain nothing from it, like caddy's encode minimum_length
+MIN_SIZE = 1024
+# a copy is only kept if it saves at least this much
+MIN_SAVING = 0.1
+
+
+def sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def etag(sha: str) -> str:
+    # a strong ETag, it's the content's hash
+    return f'"{sha[:32]}"'
+
+
+def compress(source: Path, target: Path, suffix: str) -> None:
+    partial = target.with_name(target.name + ".partial")
+    if suffix == "gz":
+        # mtime 0 so that the same file gives the same copy
+        with open(source, "rb") as f, gzip.GzipFile(partial, "wb", 9, mtime=0) as gz:
+            shutil.copyfileobj(f, gz, 1 << 20)
+    else:
+        # level 19 stays within the 8 MiB window browsers decode
+        subprocess.run(
+            ["zstd", "-19", "-q", "-f", "-T0", "-o", str(partial), str(source)],
+            check=True,
+        )
+    partial.rename(target)
+
+
+def build(src: Path, cache_dir: Path = CACHE_DIR) -> dict:
+    """Compresses the files in `src` that aren't in the cache yet and returns
+    the manifest: per file its hash, size and mtime, and per hash the
+    encodings kept with the hash of each copy."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = cache_dir / "manifest.json"
+    try:
+        previous = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        previous = {"files": {}, "objects": {}}
+    manifest = {"files": {}, "objects": {}}
+    zstd = shutil.which("zstd") is not None
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = Path(dirpath) / name
+            if path.is_symlink():
+                continue
+            relative = path.relative_to(src).as_posix()
+            stat = path.stat()
+            entry = previous["files"].get(relative)
+            if not (
+                entry
+                and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns
+            ):
+                entry = {
+                    "sha256": sha256(path),
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                }
+            manifest["files"][relative] = entry
+            sha = entry["sha256"]
+            if sha in manifest["objects"]:
+                continue
+            copies = previous["objects"].get(sha, {})
+            compressible = (
+                stat.st_size >= MIN_SIZE and path.suffix.lower() not in INCOMPRESSIBLE
+            )
+            encodings = {}
+            for suffix in SUFFIXES if compressible else ():
+                target = cache_dir / f"{sha}.{suffix}"
+                if suffix in copies and target.exists():
+                    encodings[suffix] = copies[suffix]
+                    continue
+                if suffix == "zst" and not zstd:
+                    print(f"zstd not found, {relative} isn't compressed with it")
+                    continue
+                compress(path, target, suffix)
+                size = target.stat().st_size
+                if size <= stat.st_size * (1 - MIN_SAVING):
+                    encodings[suffix] = {"sha256": sha256(target), "size": size}
+                    print(f"{relative}.{suffix} {stat.st_size} -> {size} bytes")
+                else:
+                    # not worth it, also noted so it isn't tried again
+                    target.unlink()
+                    encodings[suffix] = None
+            manifest["objects"][sha] = encodings
+    manifest_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    return manifest
+
+
+def tree(manifest: dict, src: Path, cache_dir: Path = CACHE_DIR) -> dict:
+    """What to put where in the shared folder, {path: ("file", hash, local
+    path), ("file", etag, None) for the .etag files or ("link", target,
+    None)}. A file shared twice is uploaded once, the other paths link to it."""
+    tree = {}
+    first = {}
+    for relative, entry in sorted(manifest["files"].items()):
+        sha = entry["sha256"]
+        if sha in first:
+            target = first[sha]
+            for suffix in ["", ".etag"] + [
+                f".{s}{e}"
+                for s, copy in manifest["objects"][sha].items()
+                if copy
+                for e in ("", ".etag")
+            ]:
+                link = os.path.relpath(target + suffix, os.path.dirname(relative))
+                tree[relative + suffix] = ("link", link, None)
+            continue
+        first[sha] = relative
+        tree[relative] = ("file", sha, src / relative)
+        tree[relative + ".etag"] = ("file", etag(sha), None)
+        for suffix, copy in manifest["objects"][sha].items():
+            if copy:
+                local = cache_dir / f"{sha}.{suffix}"
+                tree[f"{relative}.{suffix}"] = ("file", copy["sha256"], local)
+                tree[f"{relative}.{suffix}.etag"] = ("file", etag(copy["sha256"]), None)
+    return tree
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", type=Path)
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR)
+    args = parser.parse_args()
+    manifest = build(args.src, args.cache_dir)
+    files = tree(manifest, args.src, args.cache_dir)
+    shared = sum(entry["size"] for entry in manifest["files"].values())
+    links = sum(1 for kind, _, _ in files.values() if kind == "link")
+    print(f"{len(manifest['files'])} files, {shared} bytes, {links} links")
@@ -0,0 +1,153 @@
+import asyncio
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+# energy is measured on 30 ms frames
+FRAME_SAMPLES = SAMPLE_RATE * 30 // 1000
+
+
+# input is fed to ffmpeg in pieces, so the pipe buffers at most one of them
+PIPE_CHUNK_BYTES = 64 * 1024
+
+
+async def ffmpeg(*args: str, input: Optional[memoryview] = None) -> bytes:
+    """Run ffmpeg with `args`, writing `input` to its stdin, returns its stdout."""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        *("-hide_banner", "-loglevel", "error"),
+        *args,
+        stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            for offset in range(0, len(input), PIPE_CHUNK_BYTES):
+                process.stdin.write(input[offset : offset + PIPE_CHUNK_BYTES])
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early, its error is on stderr
+            pass
+        process.stdin.close()
+
+    feeding = [] if input is None else [feed()]
+    output, error, *_ = await asyncio.gather(
+        process.stdout.read(), process.stderr.read(), *feeding
+    )
+    await process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {error.decode().strip()}")
+    return output
+
+
+async def decode(source: Union[Path, memoryview]) -> np.ndarray:
+    """Decode audio in any format ffmpeg knows (Telegram sends OGG/Opus) to
+    16 kHz mono int16 samples.
+
+    A path is read by ffmpeg itself, so the encoded audio never passes through
+    this process."""
+    # https://ffmpeg.org/ffmpeg-formats.html#pcm
+    if isinstance(source, Path):
+        args, input = ("-i", str(source)), None
+    else:
+        args, input = ("-i", "pipe:0"), memoryview(source)
+    pcm = await ffmpeg(
+        *args,
+        *("-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"),
+        input=input,
+    )
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+async def encode(samples: np.ndarray, bitrate: str = "20k") -> bytes:
+    """Encode 16 kHz mono int16 samples as OGG/Opus, a fraction of the PCM size."""
+    # https://ffmpeg.org/ffmpeg-codecs.html#libopus-1
+    return await ffmpeg(
+        *("-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "pipe:0"),
+        *("-c:a", "libopus", "-b:a", bitrate, "-application", "voip"),
+        *("-f", "ogg", "pipe:1"),
+        # bytes, as pipe writes count len() in bytes
+        input=memoryview(np.ascontiguousarray(samples)).cast("B"),
+    )
+
+
+def frame_energy(samples: np.ndarray) -> np.ndarray:
+    """Loudness in dBFS of each frame."""
+    count = len(samples) // FRAME_SAMPLES
+    frames = samples[: count * FRAME_SAMPLES].reshape(count, FRAME_SAMPLES)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1.0) / 32768)
+
+
+def silent_frames(energy: np.ndarray, margin_db: float = 12.0) -> np.ndarray:
+    """Frames that are at most `margin_db` louder than the noise floor."""
+    if len(energy) == 0:
+        return np.zeros(0, dtype=bool)
+    noise_floor = np.percentile(energy, 10)
+    return energy < noise_floor + margin_db
+
+
+def split_on_silence(
+    samples: np.ndarray, max_seconds: float = 50, min_silence: float = 0.3
+) -> list[tuple[int, int]]:
+    """Split into (start, end) sample ranges of at most `max_seconds`.
+
+    Cuts are placed in the middle of the latest pause of at least `min_silence`
+    seconds that fits, or hard at `max_seconds` if a segment has no pause.
+    """
+    max_samples = int(max_seconds * SAMPLE_RATE)
+    if len(samples) <= max_samples:
+        return [(0, len(samples))]
+
+    # start and end frame of each run of silent frames
+    silent = silent_frames(frame_energy(samples)).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], silent, [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    long_runs = run_ends - run_starts >= min_silence * SAMPLE_RATE / FRAME_SAMPLES
+    cuts = (run_starts[long_runs] + run_ends[long_runs]) // 2 * FRAME_SAMPLES
+
+    segments = []
+    start = 0
+    while len(samples) - start > max_samples:
+        candidates = cuts[(cuts > start) & (cuts <= start + max_samples)]
+        end = int(candidates[-1]) if len(candidates) else start + max_samples
+        segments.append((start, end))
+        start = end
+    segments.append((start, len(samples)))
+    return segments
+
+
+def trim_silence(
+    samples: np.ndarray, silent: np.ndarray, padding: float = 0.2
+) -> np.ndarray:
+    """Cut leading and trailing silent frames, keeping `padding` seconds of them."""
+    voiced = np.flatnonzero(~silent)
+    pad = int(padding * SAMPLE_RATE)
+    start = max(voiced[0] * FRAME_SAMPLES - pad, 0)
+    end = min((voiced[-1] + 1) * FRAME_SAMPLES + pad, len(samples))
+    return samples[start:end]
+
+
+def normalize_loudness(
+    samples: np.ndarray, loudness_db: float, target_db: float = -20.0
+) -> np.ndarray:
+    """Scale from `loudness_db` to `target_db` dBFS without clipping."""
+    peak = max(int(np.max(np.abs(samples.astype(np.int32)))), 1)
+    gain = min(10 ** ((target_db - loudness_db) / 20), 32767 / peak)
+    return (samples * gain).astype(np.int16)
+
+
+def preprocess(samples: np.ndarray) -> np.ndarray:
+    """Trim and normalize decoded samples, meant to run in a process pool."""
+    energy = frame_energy(samples)
+    silent = silent_frames(energy)
+    if silent.all():
+        return samples
+    # mean power of the voiced frames
+    loudness_db = 10 * np.log10(np.mean(np.power(10, energy[~silent] / 10)))
+    return normalize_loudness(trim_silence(samples, silent), loudness_db)
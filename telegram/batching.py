@@ -0,0 +1,111 @@
+import asyncio
+import sys
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Hashable
+
+
+class MicroBatcher:
+    """Merges concurrent single-item calls into batch calls.
+
+    Items submitted with the same key within `window` seconds are sent together
+    as `call(items, *key)`, which must return one result per item. A batch is
+    sent early when it reaches `max_size` items or `max_chars` characters. If a
+    batch fails with an error for which `splittable` is true, one that a single
+    item can cause, its items are retried one by one so that the error only
+    reaches the caller whose item caused it. Any other error, like an outage or
+    a quota, fails every item of the batch as it is, without more calls.
+    """
+
+    def __init__(
+        self,
+        call: Callable[..., Awaitable[list]],
+        window: float = 0.05,
+        max_size: int = 32,
+        max_chars: int = 20_000,
+        splittable: Callable[[Exception], bool] = lambda error: False,
+    ):
+        self.call = call
+        self.splittable = splittable
+        self.window = window
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.pending: dict[tuple, list] = {}
+        self.timers: dict[tuple, asyncio.TimerHandle] = {}
+        self.tasks = set()
+        # metrics
+        self.batch_sizes = Counter()
+        self.wait_seconds = 0.0
+        self.items = 0
+
+    async def submit(self, item: str, *key: Hashable):
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(key, [])
+        if batch and sum(len(i) for i, _, _ in batch) + len(item) > self.max_chars:
+            self._flush(key)
+            batch = []
+        future = loop.create_future()
+        batch.append((item, future, time.monotonic()))
+        self.pending[key] = batch
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: tuple) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self._send(key, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, key: tuple, batch: list) -> None:
+        now = time.monotonic()
+        self.batch_sizes[len(batch)] += 1
+        self.items += len(batch)
+        self.wait_seconds += sum(now - queued for _, _, queued in batch)
+
+        try:
+            try:
+                results = await self.call([item for item, _, _ in batch], *key)
+            except Exception as e:
+                if len(batch) == 1 or not self.splittable(e):
+                    results = [e] * len(batch)
+                else:
+                    results = await asyncio.gather(
+                        *(self.call([item], *key) for item, _, _ in batch),
+                        return_exceptions=True,
+                    )
+                    results = [r if isinstance(r, Exception) else r[0] for r in results]
+
+            for (_, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            # cancelled at shutdown, failed outside of `call` or fewer results
+            # than items; the callers would wait forever otherwise
+            for _, future, _ in batch:
+                if not future.done():
+                    error = RuntimeError(
+                        f"batch of {len(batch)} ended without a result"
+                    )
+                    error.__cause__ = sys.exc_info()[1]
+                    future.set_exception(error)
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        return {
+            "batches": batches,
+            "items": self.items,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "mean_batch_size": self.items / batches if batches else 0.0,
+            "mean_wait_seconds": self.wait_seconds / self.items if self.items else 0.0,
+        }
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Update-to-handler latency in polling and in webhook mode: telegrambot.py runs
+# against the fake Bot API, which measures from handing out a /help update to
+# the bot's sendMessage answering it.
+#
+#   python telegram/bench/delivery.py --updates 200
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fake_botapi import FakeBotApi, command
+
+BOT = Path(__file__).resolve().parents[1].joinpath("telegrambot.py")
+
+
+def bot_env(api: FakeBotApi, db_dir: str, webhook_port: int = 0) -> dict:
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "1:fake",
+        "TELEGRAM_API_URL": api.url,
+        "TELEGRAM_DB_DIR": db_dir,
+        "GOOGLE_CLOUD_PROJECT": "fake",
+        # no provider is called for /help, the clients only need to be created
+        "GOOGLE_API_INSECURE": "1",
+        "SPEECH_API_ENDPOINT": "127.0.0.1:9",
+        "TRANSLATE_API_ENDPOINT": "127.0.0.1:9",
+        "OPENAI_API_KEY": "fake",
+    }
+    if webhook_port:
+        env["TELEGRAM_WEBHOOK_URL"] = f"http://127.0.0.1:{webhook_port}/telegram"
+        env["TELEGRAM_WEBHOOK_PORT"] = str(webhook_port)
+        env["TELEGRAM_WEBHOOK_SECRET"] = "fake-secret"
+    return env
+
+
+def wait_for(event: threading.Event, process: subprocess.Popen, timeout: float):
+    if not event.wait(timeout):
+        process.kill()
+        raise TimeoutError("bot didn't start")
+
+
+def measure(mode: str, updates: int, webhook_port: int) -> list[float]:
+    api = FakeBotApi().start()
+    ready = threading.Event()
+    answered = threading.Event()
+    answered_at = []
+
+    def on_call(method: str, params: dict, at: float):
+        if method in ("getUpdates", "setWebhook"):
+            ready.set()
+        if method == "sendMessage":
+            answered_at.append(at)
+            answered.set()
+
+    api.on_call.append(on_call)
+    with tempfile.TemporaryDirectory() as db_dir:
+        env = bot_env(api, db_dir, webhook_port if mode == "webhook" else 0)
+        process = subprocess.Popen(
+            [sys.executable, str(BOT)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(ready, process, 60)
+            # webhook mode: the listener is up before setWebhook is called
+            time.sleep(0.5)
+            latencies = []
+            for i in range(updates):
+                answered.clear()
+                pushed_at = time.monotonic()
+                api.push(command(1000 + i, 1, "/help"))
+                if not answered.wait(10):
+                    raise TimeoutError(f"no answer to update {i}")
+                latencies.append(answered_at[-1] - pushed_at)
+            return latencies
+        finally:
+            process.terminate()
+            process.wait(10)
+            api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--webhook-port", type=int, default=18443)
+    args = parser.parse_args()
+
+    for mode in ("polling", "webhook"):
+        latencies = sorted(measure(mode, args.updates, args.webhook_port))
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        mean = statistics.mean(latencies) * 1000
+        print(f"{mode:8} p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  mean {mean:6.1f} ms")
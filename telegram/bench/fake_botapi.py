@@ -0,0 +1,240 @@
+# A local stand-in for the Telegram Bot API, enough to run telegrambot.py
+# against it in polling and in webhook mode. Point the bot at it with
+# TELEGRAM_API_URL=fake.url.
+# https://core.telegram.org/bots/api
+
+import json
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qsl
+
+from latency import Latency
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "fake",
+    "username": "fake_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": True,
+    "supports_inline_queries": False,
+}
+
+
+class Server(ThreadingHTTPServer):
+    # the default backlog of 5 resets connections when the bot sends a burst
+    # of answers, like after taking over the updates of a restart
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeBotApi:
+    """Serves Bot API methods from memory and records the bot's calls.
+
+    `push` queues an update, it's returned by getUpdates or, once the bot set a
+    webhook, posted to it. Every call of the bot is passed to the `on_call`
+    listeners as (method, params, time.monotonic()), and once answered to the
+    `on_result` listeners as (method, params, result, time.monotonic()).
+
+    Calls other than getUpdates take `latency` and fail at its error rate.
+    """
+
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 0, latency: Latency = Latency()
+    ):
+        self.latency = latency
+        self.on_result: list[Callable[[str, dict, object, float], None]] = []
+        self.updates: list[dict] = []
+        self.update_id = 0
+        self.message_id = 0
+        self.files: dict[str, bytes] = {}
+        self.webhook: Optional[tuple[str, str]] = None
+        self.webhook_queue = queue.Queue()
+        self.condition = threading.Condition()
+        self.on_call: list[Callable[[str, dict, float], None]] = []
+        self.server = Server((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self) -> "FakeBotApi":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._deliver_webhooks, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, update: dict) -> dict:
+        with self.condition:
+            self.update_id += 1
+            update = {"update_id": self.update_id, **update}
+            if self.webhook is not None:
+                self.webhook_queue.put(update)
+            else:
+                self.updates.append(update)
+                self.condition.notify_all()
+        return update
+
+    def add_file(self, file_id: str, data: bytes) -> None:
+        self.files[file_id] = data
+
+    def message(self, chat_id: int, **fields) -> dict:
+        with self.condition:
+            self.message_id += 1
+            message_id = self.message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            **fields,
+        }
+
+    def _call(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "setWebhook":
+            with self.condition:
+                self.webhook = (params["url"], params.get("secret_token", ""))
+                for update in self.updates:
+                    self.webhook_queue.put(update)
+                self.updates = []
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            message = self.message(chat_id, text=params.get("text", ""))
+            if "message_id" in params:
+                message["message_id"] = int(params["message_id"])
+            message["from"] = BOT_USER
+            return message
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"voice/{file_id}.ogg",
+            }
+        return True
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset", 0))
+        deadline = time.monotonic() + float(params.get("timeout", 0))
+        with self.condition:
+            while True:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return list(self.updates)
+                self.condition.wait(remaining)
+
+    def _deliver_webhooks(self) -> None:
+        # like Telegram, one update at a time, retried until it's accepted
+        while True:
+            update = self.webhook_queue.get()
+            while self.webhook is not None:
+                url, secret = self.webhook
+                request = urllib.request.Request(
+                    url,
+                    data=json.dumps(update).encode(),
+                    headers={
+                        "Content-Type": "application/json",
+                        "X-Telegram-Bot-Api-Secret-Token": secret,
+                    },
+                )
+                try:
+                    urllib.request.urlopen(request, timeout=10).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                # /file/bot<token>/voice/<file_id>.ogg
+                file_id = self.path.rsplit("/", 1)[-1].removesuffix(".ogg")
+                self._reply(200, api.files.get(file_id, b""), "audio/ogg")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = dict(parse_qsl(body))
+                method = self.path.rsplit("/", 1)[-1]
+                for listener in api.on_call:
+                    listener(method, params, time.monotonic())
+                if method != "getUpdates" and api.latency.wait():
+                    body = json.dumps(
+                        {"ok": False, "error_code": 500, "description": "injected"}
+                    ).encode()
+                    self._reply(500, body, "application/json")
+                    return
+                result = api._call(method, params)
+                for listener in api.on_result:
+                    listener(method, params, result, time.monotonic())
+                body = json.dumps({"ok": True, "result": result}).encode()
+                self._reply(200, body, "application/json")
+
+            def _reply(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the bot stopped while polling
+                    pass
+
+        return Handler
+
+
+def command(chat_id: int, user_id: int, text: str) -> dict:
+    """Update for a command message like "/help"."""
+    length = len(text.split(" ", 1)[0])
+    return {
+        "message": {
+            "message_id": chat_id % 1000000,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": length}],
+        }
+    }
+
+
+def voice(chat_id: int, user_id: int, file_id: str, duration: int, size: int) -> dict:
+    """Update for a voice message, its file added with FakeBotApi.add_file."""
+    return {
+        "message": {
+            "message_id": chat_id % 1000000,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "voice": {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "duration": duration,
+                "mime_type": "audio/ogg",
+                "file_size": size,
+            },
+        }
+    }
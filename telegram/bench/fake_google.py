@@ -0,0 +1,126 @@
+# Local stand-ins for the Speech-to-Text v2 and Translation v3 gRPC services,
+# enough for telegrambot.py's Recognize, StreamingRecognize and TranslateText.
+# Point the bot at them with GOOGLE_API_INSECURE=1 and SPEECH_API_ENDPOINT /
+# TRANSLATE_API_ENDPOINT=fake.address.
+# https://grpc.github.io/grpc/python/grpc.html#grpc.method_handlers_generic_handler
+
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from google.cloud.speech_v2.types import cloud_speech
+from google.cloud.translate_v3.types import translation_service
+from latency import Latency
+
+# PCM is 32 KB per second at 16 kHz, so this is a word per ~0.4 s
+BYTES_PER_WORD = 12 * 1024
+TRANSLATED = "translated: "
+
+
+def transcript(audio_bytes: int) -> str:
+    return " ".join(f"word{i}" for i in range(max(audio_bytes // BYTES_PER_WORD, 1)))
+
+
+class FakeGoogle:
+    """Serves Recognize, StreamingRecognize and TranslateText on one port.
+
+    The transcript is a word per chunk of audio, the translation the text with
+    TRANSLATED in front. `calls` counts the requests by method.
+    """
+
+    def __init__(
+        self,
+        speech: Latency = Latency(),
+        translate: Latency = Latency(),
+        host: str = "127.0.0.1",
+        port: int = 0,
+        workers: int = 64,
+    ):
+        self.speech = speech
+        self.translate = translate
+        self.calls = {"Recognize": 0, "StreamingRecognize": 0, "TranslateText": 0}
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=workers))
+        self.server.add_generic_rpc_handlers(
+            (
+                grpc.method_handlers_generic_handler(
+                    "google.cloud.speech.v2.Speech",
+                    {
+                        "Recognize": grpc.unary_unary_rpc_method_handler(
+                            self.recognize,
+                            request_deserializer=cloud_speech.RecognizeRequest.deserialize,
+                            response_serializer=cloud_speech.RecognizeResponse.serialize,
+                        ),
+                        "StreamingRecognize": grpc.stream_stream_rpc_method_handler(
+                            self.streaming_recognize,
+                            request_deserializer=cloud_speech.StreamingRecognizeRequest.deserialize,
+                            response_serializer=cloud_speech.StreamingRecognizeResponse.serialize,
+                        ),
+                    },
+                ),
+                grpc.method_handlers_generic_handler(
+                    "google.cloud.translation.v3.TranslationService",
+                    {
+                        "TranslateText": grpc.unary_unary_rpc_method_handler(
+                            self.translate_text,
+                            request_deserializer=translation_service.TranslateTextRequest.deserialize,
+                            response_serializer=translation_service.TranslateTextResponse.serialize,
+                        ),
+                    },
+                ),
+            )
+        )
+        self.port = self.server.add_insecure_port(f"{host}:{port}")
+        self.address = f"{host}:{self.port}"
+
+    def start(self) -> "FakeGoogle":
+        self.server.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.stop(grace=None)
+
+    def _fail(self, context: grpc.ServicerContext, latency: Latency) -> None:
+        if latency.wait():
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected error")
+
+    def recognize(self, request, context):
+        self.calls["Recognize"] += 1
+        self._fail(context, self.speech)
+        alternative = cloud_speech.SpeechRecognitionAlternative(
+            transcript=transcript(len(request.content))
+        )
+        return cloud_speech.RecognizeResponse(
+            results=[cloud_speech.SpeechRecognitionResult(alternatives=[alternative])]
+        )
+
+    def streaming_recognize(self, requests, context):
+        self.calls["StreamingRecognize"] += 1
+        received = 0
+        words = 0
+        for request in requests:
+            received += len(request.audio)
+            # interim results while the audio arrives, the final one at its end
+            if received // BYTES_PER_WORD > words:
+                words = received // BYTES_PER_WORD
+                yield self._streaming_response(transcript(received), final=False)
+        self._fail(context, self.speech)
+        yield self._streaming_response(transcript(received), final=True)
+
+    def _streaming_response(self, text: str, final: bool):
+        return cloud_speech.StreamingRecognizeResponse(
+            results=[
+                cloud_speech.StreamingRecognitionResult(
+                    alternatives=[cloud_speech.SpeechRecognitionAlternative(transcript=text)],
+                    is_final=final,
+                )
+            ]
+        )
+
+    def translate_text(self, request, context):
+        self.calls["TranslateText"] += 1
+        self._fail(context, self.translate)
+        return translation_service.TranslateTextResponse(
+            translations=[
+                translation_service.Translation(translated_text=TRANSLATED + text)
+                for text in request.contents
+            ]
+        )
@@ -0,0 +1,116 @@
+# A local stand-in for OpenAI's streamed chat completions. Point the bot at it
+# with OPENAI_BASE_URL=fake.url.
+# https://platform.openai.com/docs/api-reference/chat/streaming
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from latency import Latency
+
+SUGGESTION_END = "[end of suggestions]"
+
+
+class FakeOpenAI:
+    """Streams a fixed answer as chat.completion.chunk events.
+
+    `latency` is the time to the first token, `token_delay` the time between
+    the following ones. Failed requests are answered with a 500, which the
+    OpenAI client retries.
+    """
+
+    def __init__(
+        self,
+        latency: Latency = Latency(),
+        token_delay: float = 0.0,
+        tokens: int = 40,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.calls = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _chunks(self, model: str):
+        words = [f"answer{i} " for i in range(self.tokens)] + [SUGGESTION_END]
+        for i, word in enumerate(words):
+            yield {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "content": word,
+                            **({"role": "assistant"} if i == 0 else {}),
+                        },
+                        "finish_reason": "stop" if i == len(words) - 1 else None,
+                    }
+                ],
+            }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                # /v1/models, which the bot lists to warm up its connection
+                body = json.dumps({"object": "list", "data": []}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                fake.calls += 1
+                if fake.latency.wait():
+                    body = json.dumps(
+                        {"error": {"message": "injected error", "type": "server_error"}}
+                    ).encode()
+                    self.send_response(500)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, chunk in enumerate(fake._chunks(request.get("model", "gpt-4o"))):
+                    if i:
+                        time.sleep(fake.token_delay)
+                    self._write(f"data: {json.dumps(chunk)}\n\n")
+                self._write("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write(self, event: str):
+                data = event.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,46 @@
+# Latency and error model shared by the fake providers.
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class Latency:
+    """Log-normal response times around `median` seconds, failing at `error_rate`.
+
+    `sigma` is the spread of the underlying normal distribution, 0.5 puts the
+    p99 at about 3x the median.
+    """
+
+    median: float = 0.0
+    sigma: float = 0.5
+    error_rate: float = 0.0
+    seed: int = 0
+
+    def __post_init__(self):
+        self.random = random.Random(self.seed)
+        # the fakes serve from several threads
+        self.lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self.lock:
+            return self.random.lognormvariate(0, self.sigma) * self.median
+
+    def fails(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def wait(self) -> bool:
+        """Sleep for a sampled latency, True if the request should fail."""
+        time.sleep(self.sample())
+        return self.fails()
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "Latency":
+        """From "median[,sigma[,error_rate]]", e.g. "0.5,0.4,0.01"."""
+        values = [float(v) for v in spec.split(",")] if spec else []
+        return cls(*values, seed=seed)
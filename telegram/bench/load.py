@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+# Load test of telegrambot.py against local stand-ins for the Bot API, Speech,
+# Translate and OpenAI. Voice messages are replayed across chats. For each
+# scenario it reports throughput, end-to-end latency percentiles and the bot's
+# peak RSS. The end-to-end latency runs from pushing the update to the final
+# edit of its last message.
+#
+#   python telegram/bench/load.py                        # all scenarios
+#   python telegram/bench/load.py smoke steady --save baseline.json
+#   python telegram/bench/load.py --compare baseline.json  # exits 1 on regressions
+#
+# Needs ffmpeg on PATH, like the bot.
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from delivery import BOT, bot_env, wait_for
+from fake_botapi import FakeBotApi, command, voice
+from fake_google import TRANSLATED, FakeGoogle
+from fake_openai import SUGGESTION_END, FakeOpenAI
+from latency import Latency
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import audio  # noqa: E402
+
+
+@dataclass
+class Scenario:
+    voices: int
+    chats: int
+    # voice messages per second, 0 pushes them all at once
+    rate: float
+    # seconds, picked at random for each voice message
+    durations: tuple[int, ...] = (5, 8, 12)
+    suggestions: bool = False
+    # "median[,sigma[,error_rate]]" per fake, see Latency.parse
+    speech: str = "0.3,0.5"
+    translate: str = "0.05,0.5"
+    openai: str = "0.3,0.5"
+    botapi: str = "0.02,0.5"
+    # a second speech region, as SPEECH_REGIONS' second entry
+    speech_backup: str = ""
+    # extra environment of the bot, e.g. to try other limits
+    env: dict = field(default_factory=dict)
+
+
+SCENARIOS = {
+    "smoke": Scenario(voices=20, chats=10, rate=10),
+    "steady": Scenario(voices=200, chats=50, rate=20),
+    # more than VOICE_QUEUE at once, the rest is turned away as busy
+    "burst": Scenario(voices=150, chats=30, rate=0),
+    # streamed (>= 10 s) and split (>= 55 s) recognition
+    "long": Scenario(voices=30, chats=10, rate=3, durations=(20, 70)),
+    "suggestions": Scenario(voices=60, chats=15, rate=10, suggestions=True),
+    "faulty": Scenario(
+        voices=100,
+        chats=20,
+        rate=20,
+        suggestions=True,
+        speech="0.3,0.5,0.05",
+        translate="0.05,0.5,0.05",
+        openai="0.3,0.5,0.05",
+        botapi="0.02,0.5,0.01",
+    ),
+    # a region with a long tail and errors, and a steady backup region
+    "slow-region": Scenario(
+        voices=100,
+        chats=25,
+        rate=5,
+        speech="0.3,1.2,0.03",
+        speech_backup="0.4,0.4",
+        # without ffmpeg's CPU time the recognition dominates
+        env={"AUDIO_PREPROCESSING": "off"},
+    ),
+    "slow-region-unhedged": Scenario(
+        voices=100,
+        chats=25,
+        rate=5,
+        speech="0.3,1.2,0.03",
+        speech_backup="0.4,0.4",
+        env={"AUDIO_PREPROCESSING": "off", "SPEECH_HEDGING": "off"},
+    ),
+}
+
+
+@dataclass
+class Job:
+    chat_id: int
+    file_id: str
+    pushed: float
+    done: Optional[float] = None
+    # "ok", "error" or "busy"
+    outcome: str = ""
+    # message id -> "transcript", "translation" or "suggestion"
+    messages: dict = field(default_factory=dict)
+    # the messages still waiting for their final text
+    pending: set = field(default_factory=set)
+
+
+class Tracker:
+    """Follows the bot's calls to tell when each voice message is answered.
+
+    A chat's voice messages are processed one after another, so the messages
+    sent to a chat belong to the voice message whose file was fetched last.
+    """
+
+    def __init__(self, suggestions: bool):
+        self.suggestions = suggestions
+        self.jobs: dict[str, Job] = {}
+        self.current: dict[int, Job] = {}
+        self.transcript_message: dict[int, int] = {}
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+
+    def add(self, job: Job) -> None:
+        with self.lock:
+            self.jobs[job.file_id] = job
+
+    def on_call(self, method: str, params: dict, at: float) -> None:
+        if method != "getFile":
+            return
+        with self.lock:
+            job = self.jobs.get(params["file_id"])
+            if job is None or job.messages:
+                return
+            chat_id = job.chat_id
+            job.messages[self.transcript_message.pop(chat_id, 0)] = "transcript"
+            job.pending = {"translation"} | (
+                {"suggestion"} if self.suggestions else set()
+            )
+            self.current[chat_id] = job
+
+    def on_result(self, method: str, params: dict, result, at: float) -> None:
+        if method not in ("sendMessage", "editMessageText"):
+            return
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        with self.lock:
+            if method == "sendMessage":
+                if text == "🎙...":
+                    self.transcript_message[chat_id] = result["message_id"]
+                elif text.startswith("✘ busy"):
+                    self.busy += 1
+                    self.finished.notify_all()
+                elif chat_id in self.current:
+                    kind = {"文A ...": "translation", "✏️...": "suggestion"}.get(text)
+                    if kind is not None:
+                        self.current[chat_id].messages[result["message_id"]] = kind
+                return
+
+            job = self.current.get(chat_id)
+            kind = job and job.messages.get(int(params["message_id"]))
+            if job is None or kind is None or job.done is not None:
+                # e.g. the edit of the transcript message before getFile
+                return
+            if text == "✘":
+                job.outcome = "error"
+                job.pending.discard(kind)
+                if kind == "transcript":
+                    job.pending.clear()
+            elif kind == "translation" and TRANSLATED in text:
+                job.pending.discard(kind)
+            elif kind == "suggestion" and SUGGESTION_END in text:
+                job.pending.discard(kind)
+            if not job.pending:
+                job.done = at
+                job.outcome = job.outcome or "ok"
+                self.finished.notify_all()
+
+    def wait(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while time.monotonic() < deadline:
+                done = sum(job.done is not None for job in self.jobs.values())
+                if done + self.busy >= len(self.jobs):
+                    return
+                self.finished.wait(deadline - time.monotonic())
+
+
+def speech_like(seconds: int, seed: int) -> np.ndarray:
+    """Bursts of tones and pauses over faint noise, at 16 kHz."""
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 30, seconds * audio.SAMPLE_RATE)
+    position = 0
+    while position < len(samples):
+        burst = int(rng.uniform(0.3, 1.2) * audio.SAMPLE_RATE)
+        t = np.arange(min(burst, len(samples) - position)) / audio.SAMPLE_RATE
+        samples[position : position + len(t)] += 6000 * np.sin(
+            2 * np.pi * rng.uniform(150, 400) * t
+        )
+        position += burst + int(rng.uniform(0.2, 0.6) * audio.SAMPLE_RATE)
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+def clips(durations: tuple[int, ...]) -> dict[int, bytes]:
+    async def encode():
+        return await asyncio.gather(
+            *(audio.encode(speech_like(d, seed=d)) for d in durations)
+        )
+
+    return dict(zip(durations, asyncio.run(encode())))
+
+
+def peak_rss(pid: int) -> int:
+    """VmHWM in bytes of the process and its children, e.g. the audio pool."""
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                stat = entry.joinpath("stat").read_text()
+            except OSError:
+                continue
+            parents[int(entry.name)] = int(stat.rsplit(")", 1)[1].split()[1])
+    pids, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        pids.append(current)
+        queue.extend(child for child, parent in parents.items() if parent == current)
+    total = 0
+    for current in pids:
+        try:
+            status = Path(f"/proc/{current}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(
+    name: str, scenario: Scenario, seed: int, metrics_dir: Optional[Path] = None
+) -> dict:
+    rng = random.Random(seed)
+    api = FakeBotApi(latency=Latency.parse(scenario.botapi, seed)).start()
+    google = FakeGoogle(
+        speech=Latency.parse(scenario.speech, seed + 1),
+        translate=Latency.parse(scenario.translate, seed + 2),
+    ).start()
+    openai = FakeOpenAI(latency=Latency.parse(scenario.openai, seed + 3)).start()
+    backup = None
+    if scenario.speech_backup:
+        backup = FakeGoogle(speech=Latency.parse(scenario.speech_backup, seed + 4))
+        backup.start()
+    tracker = Tracker(scenario.suggestions)
+    api.on_call.append(tracker.on_call)
+    api.on_result.append(tracker.on_result)
+    ready = threading.Event()
+    reactions = threading.Semaphore(0)
+
+    def on_call(method: str, params: dict, at: float):
+        if method == "getUpdates":
+            ready.set()
+        if method == "setMessageReaction":
+            reactions.release()
+
+    api.on_call.append(on_call)
+    audio_clips = clips(scenario.durations)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        env = {
+            **bot_env(api, db_dir),
+            "SPEECH_API_ENDPOINT": google.address,
+            "TRANSLATE_API_ENDPOINT": google.address,
+            "OPENAI_BASE_URL": openai.url,
+            "METRICS_PORT": str(free_port()) if metrics_dir else "0",
+            **(
+                {
+                    "SPEECH_REGIONS": f"europe-west4={google.address},"
+                    f"us-central1={backup.address}"
+                }
+                if backup
+                else {}
+            ),
+            **scenario.env,
+        }
+        process = subprocess.Popen(
+            [sys.executable, str(BOT)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(ready, process, 60)
+            chats = [-1000000000000 - i for i in range(scenario.chats)]
+            if scenario.suggestions:
+                # makes the sender the trainer, who gets suggestions
+                for chat_id in chats:
+                    api.push(command(chat_id, 1, "/suggestions on"))
+                for _ in chats:
+                    reactions.acquire(timeout=10)
+
+            started = time.monotonic()
+            for i in range(scenario.voices):
+                if scenario.rate:
+                    time.sleep(max(started + i / scenario.rate - time.monotonic(), 0))
+                duration = rng.choice(scenario.durations)
+                file_id = f"voice{i}"
+                # a unique tail, so that no transcript comes from the cache;
+                # ffmpeg ignores it
+                data = audio_clips[duration] + f"\0{name}-{seed}-{i}".encode()
+                api.add_file(file_id, data)
+                chat_id = rng.choice(chats)
+                job = Job(chat_id, file_id, pushed=time.monotonic())
+                tracker.add(job)
+                api.push(voice(chat_id, 1, file_id, duration, len(data)))
+            tracker.wait(timeout=120 + max(scenario.durations) * 2)
+            rss = peak_rss(process.pid)
+            if metrics_dir:
+                # the bot's own view of where the time went
+                url = f"http://127.0.0.1:{env['METRICS_PORT']}/metrics"
+                with urllib.request.urlopen(url) as response:
+                    metrics_dir.joinpath(f"{name}.prom").write_bytes(response.read())
+        finally:
+            process.terminate()
+            process.wait(30)
+            api.stop()
+            google.stop()
+            openai.stop()
+            if backup:
+                backup.stop()
+
+    jobs = list(tracker.jobs.values())
+    finished = [job for job in jobs if job.done is not None]
+    latencies = [job.done - job.pushed for job in finished]
+    elapsed = max((job.done for job in finished), default=started) - started
+    return {
+        "voices": len(jobs),
+        "ok": sum(job.outcome == "ok" for job in finished),
+        "errors": sum(job.outcome == "error" for job in finished),
+        "busy": tracker.busy,
+        "lost": len(jobs) - len(finished) - tracker.busy,
+        "throughput": round(len(finished) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50": round(percentile(latencies, 0.50), 3),
+        "p95": round(percentile(latencies, 0.95), 3),
+        "p99": round(percentile(latencies, 0.99), 3),
+        "peak_rss_mib": round(rss / (1 << 20), 1),
+        "calls": {
+            **google.calls,
+            **{f"{m}@backup": n for m, n in (backup.calls if backup else {}).items()},
+            "ChatCompletions": openai.calls,
+        },
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in ("p50", "p95", "p99", "peak_rss_mib"):
+            if result[key] > before[key] * (1 + tolerance):
+                found.append(f"{name}: {key} {before[key]} -> {result[key]}")
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            found.append(
+                f"{name}: throughput {before['throughput']} -> {result['throughput']}"
+            )
+        if result["lost"] > before["lost"]:
+            found.append(f"{name}: lost {before['lost']} -> {result['lost']}")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="baseline results as JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--metrics-dir", type=Path, help="keep the bot's /metrics per scenario"
+    )
+    args = parser.parse_args()
+    if args.metrics_dir:
+        args.metrics_dir.mkdir(parents=True, exist_ok=True)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        result = results[name] = run(name, SCENARIOS[name], args.seed, args.metrics_dir)
+        print(
+            f"{name:12} {result['ok']:4}/{result['voices']} ok"
+            f" {result['errors']:3} errors {result['busy']:3} busy"
+            f" {result['lost']:3} lost  {result['throughput']:6.2f}/s"
+            f"  p50 {result['p50']:6.2f} s  p95 {result['p95']:6.2f} s"
+            f"  p99 {result['p99']:6.2f} s  rss {result['peak_rss_mib']:6.1f} MiB"
+        )
+        print(f"{'':12} provider calls {json.dumps(result['calls'])}")
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2) + "\n")
+    if args.compare:
+        found = regressions(
+            results, json.loads(args.compare.read_text()), args.tolerance
+        )
+        for regression in found:
+            print(f"regression {regression}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Migrate a synthetic config.json with many chats into a fresh store and report
+# time and peak RSS.
+#
+#   python telegram/bench/migrations.py --chats 1000000 --version 2
+
+import argparse
+import json
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from db import Store  # noqa: E402
+from migrations import migrate_file  # noqa: E402
+
+LANGUAGES = ["de-DE", "en-US", "uk-UA"]
+
+
+def write_config(path: Path, chats: int, version: int) -> None:
+    """Write the file chat by chat so that generating it doesn't use memory."""
+    with open(path, "w") as file:
+        if version == 1:
+            json.dump({"trainer_language": "de-DE", "learner_language": "en-US"}, file)
+            return
+        file.write(f'{{\n  "version": {version},\n  "chats": {{')
+        for i in range(chats):
+            chat = {
+                "trainer_language": random.choice(LANGUAGES),
+                "learner_language": random.choice(LANGUAGES),
+                "trainer_id": random.randrange(1 << 40),
+            }
+            if version >= 3:
+                chat["suggestions"] = random.random() < 0.5
+            separator = "," if i else ""
+            file.write(f'{separator}\n    "{-i - 1}": {json.dumps(chat, indent=6)}')
+        file.write("\n  }")
+        if version == 2:
+            file.write(',\n  "default": {"trainer_language": "de-DE", "learner_language": "en-US"}')
+        file.write("\n}\n")
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=1_000_000)
+    parser.add_argument("--version", type=int, choices=[1, 2, 3], default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        path = directory.joinpath("config.json")
+        write_config(path, args.chats, args.version)
+        size = path.stat().st_size / 2**20
+        rss_before = peak_rss_mb()
+
+        store = Store("config", directory)
+        started = time.perf_counter()
+        version = migrate_file(path, store)
+        elapsed = time.perf_counter() - started
+
+        print(f"v{args.version} -> v{version}: {len(store)} chats, {size:.0f} MiB")
+        print(f"time:     {elapsed:.1f} s ({len(store) / elapsed:.0f} chats/s)")
+        print(f"peak rss: {peak_rss_mb():.0f} MiB (before migration {rss_before:.0f} MiB)")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Memory per chat of the chat registry, compared to a dict of plain dataclasses
+# as config.json was loaded before.
+#
+#   python telegram/bench/registry.py --chats 100000
+
+import argparse
+import json
+import random
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from migrations import LANGUAGE_CODES, ChatConfig, Chats  # noqa: E402
+
+
+@dataclass
+class PlainChatConfig:
+    trainer_language: str = "de-DE"
+    learner_language: str = "en-US"
+    suggestions: bool = False
+    trainer_id: int = -1
+
+
+def records(chats: int) -> list[tuple[int, str]]:
+    return [
+        (
+            -1000000000000 + i,
+            json.dumps(
+                {
+                    "trainer_language": random.choice(LANGUAGE_CODES),
+                    "learner_language": random.choice(LANGUAGE_CODES),
+                    "suggestions": random.random() < 0.5,
+                    "trainer_id": random.randrange(1 << 40),
+                }
+            ),
+        )
+        for i in range(chats)
+    ]
+
+
+def measure(fill) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = fill()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del registry
+    return after - before
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100_000)
+    args = parser.parse_args()
+    data = records(args.chats)
+
+    def fill_plain():
+        return {chat_id: PlainChatConfig(**json.loads(r)) for chat_id, r in data}
+
+    def fill_compact():
+        chats = Chats(max_resident=args.chats)
+        for chat_id, r in data:
+            chats._insert(chat_id, ChatConfig(**json.loads(r)))
+        return chats
+
+    plain = measure(fill_plain) / args.chats
+    compact = measure(fill_compact) / args.chats
+    print(f"dict of dataclasses: {plain:.0f} bytes per chat")
+    print(f"Chats:               {compact:.0f} bytes per chat ({plain / compact:.0f}x less)")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Deploy-time downtime: a second bot instance takes over from the first like
+# on a deploy (see handoff.py), in polling mode against the fakes. /help
+# commands are pushed throughout and voice messages just before the handoff.
+# Reports the gap the new instance measured, the answer times of commands
+# before, while the new instance starts and around the handoff, how long the
+# old instance drained and whether all voice messages were answered, by the
+# old instance or resumed by the new one.
+#
+#   python telegram/bench/restart.py --voices 20
+#
+# Needs ffmpeg on PATH, like the bot.
+
+import argparse
+import json
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from delivery import BOT, bot_env
+from fake_botapi import FakeBotApi, command, voice
+from fake_google import TRANSLATED, FakeGoogle
+from fake_openai import FakeOpenAI
+from latency import Latency
+from load import clips, free_port, percentile
+
+VOICE_SECONDS = 5
+
+
+def health(port: int) -> dict:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz") as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        return json.load(e)
+    except OSError:
+        return {"state": None}
+
+
+def wait_until(ready, timeout: float, interval: float = 0.01) -> None:
+    deadline = time.monotonic() + timeout
+    while not ready():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(interval)
+
+
+def run(voices: int, command_interval: float, speech: str, drain: float) -> None:
+    api = FakeBotApi().start()
+    google = FakeGoogle(speech=Latency.parse(speech)).start()
+    openai = FakeOpenAI().start()
+    lock = threading.Lock()
+    pushed: dict[int, float] = {}
+    answered: dict[int, float] = {}
+    translated: set[int] = set()
+
+    def on_call(method: str, params: dict, at: float):
+        text = params.get("text", "")
+        chat_id = int(params.get("chat_id", 0))
+        with lock:
+            if method == "sendMessage" and "/lang" in text:
+                answered.setdefault(chat_id, at)
+            elif method == "editMessageText" and TRANSLATED in text:
+                translated.add(chat_id)
+
+    api.on_call.append(on_call)
+    voice_clip = clips((VOICE_SECONDS,))[VOICE_SECONDS]
+    stop_commands = threading.Event()
+
+    def push_commands():
+        chat_id = 1000
+        while not stop_commands.is_set():
+            with lock:
+                pushed[chat_id] = time.monotonic()
+            api.push(command(chat_id, 1, "/help"))
+            chat_id += 1
+            time.sleep(command_interval)
+
+    # commands are reported by the phase they were pushed in
+    phases = {"before": 0.0}
+    gap = drained = float("nan")
+    with tempfile.TemporaryDirectory() as db_dir:
+        instances = []
+
+        def start() -> tuple[subprocess.Popen, int]:
+            port = free_port()
+            env = {
+                **bot_env(api, db_dir),
+                "SPEECH_API_ENDPOINT": google.address,
+                "TRANSLATE_API_ENDPOINT": google.address,
+                "OPENAI_BASE_URL": openai.url,
+                "METRICS_PORT": str(port),
+                "TELEGRAM_DRAIN_SECONDS": str(drain),
+            }
+            process = subprocess.Popen(
+                [sys.executable, str(BOT)],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            instances.append(process)
+            return process, port
+
+        try:
+            old, old_port = start()
+            wait_until(lambda: health(old_port)["state"] == "serving", 60)
+            commands = threading.Thread(target=push_commands, daemon=True)
+            commands.start()
+            time.sleep(1)
+
+            phases["new instance starting"] = time.monotonic()
+            new, new_port = start()
+            wait_until(lambda: health(new_port)["state"] == "standby", 60)
+            # in processing or queued when the old instance is stopped
+            for i in range(voices):
+                file_id = f"voice{i}"
+                data = voice_clip + f"\0{i}".encode()
+                api.add_file(file_id, data)
+                api.push(voice(-2000 - i, 1, file_id, VOICE_SECONDS, len(data)))
+            time.sleep(0.5)
+
+            stopped = time.monotonic()
+            phases["handoff"] = stopped
+            old.send_signal(signal.SIGTERM)
+            wait_until(lambda: health(new_port)["handoff_gap_seconds"] is not None, 30)
+            gap = health(new_port)["handoff_gap_seconds"]
+            old.wait(drain + 30)
+            drained = time.monotonic() - stopped
+
+            phases["after the handoff"] = time.monotonic()
+            time.sleep(1)
+            stop_commands.set()
+            commands.join()
+            wait_until(lambda: len(translated) >= voices, 60 + voices, interval=0.1)
+            wait_until(lambda: len(answered) >= len(pushed), 30, interval=0.1)
+        except TimeoutError:
+            pass
+        finally:
+            stop_commands.set()
+            for process in instances:
+                process.terminate()
+                process.wait(drain + 30)
+            api.stop()
+            google.stop()
+            openai.stop()
+
+    print(f"handoff gap      {gap * 1000:7.1f} ms")
+    print(f"old drained in   {drained:7.2f} s")
+    print(f"voice messages   {len(translated)}/{voices} translated")
+    print("commands")
+    starts = list(phases.values())
+    for (name, start), end in zip(phases.items(), starts[1:] + [float("inf")]):
+        chats = [c for c, at in pushed.items() if start <= at < end]
+        latencies = [answered[c] - pushed[c] for c in chats if c in answered]
+        print(
+            f"  {name:22} {len(chats):4} pushed {len(chats) - len(latencies):3} lost"
+            f"  p50 {percentile(latencies, 0.5) * 1000:6.0f} ms"
+            f"  max {max(latencies, default=float('nan')) * 1000:6.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voices", type=int, default=20)
+    parser.add_argument("--command-interval", type=float, default=0.02)
+    parser.add_argument("--speech", default="1.0,0.5", help="see Latency.parse")
+    parser.add_argument("--drain", type=float, default=30)
+    args = parser.parse_args()
+    run(args.voices, args.command_interval, args.speech, args.drain)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Startup cost of telegrambot.py. First the import time of its modules, from
+# python -X importtime, split into what the bot imports before it polls and
+# what it imports in the background afterwards. Then, with the bot started
+# against the fakes, the time from starting the process until it polls, and
+# until it answers a /help command and a voice message that were already
+# waiting.
+#
+#   python telegram/bench/startup.py --runs 5
+#
+# Needs ffmpeg on PATH, like the bot.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from delivery import BOT, bot_env, wait_for
+from fake_botapi import FakeBotApi, command, voice
+from fake_google import TRANSLATED, FakeGoogle
+from fake_openai import FakeOpenAI
+from load import clips
+
+VOICE_SECONDS = 5
+
+
+def import_times(db_dir: str) -> dict[str, list[tuple[str, float]]]:
+    """(module, cumulative seconds) of the modules the bot imports, and of the
+    provider SDKs imported afterwards, like start_providers does."""
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "1:fake",
+        "TELEGRAM_DB_DIR": db_dir,
+        # skips looking for Google credentials
+        "GOOGLE_API_INSECURE": "1",
+    }
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import sys, telegrambot, clients; print('providers', file=sys.stderr);"
+            "clients.import_providers(); print('done', file=sys.stderr)",
+        ],
+        cwd=BOT.parent,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # a module is listed after the ones it imports, indented one level less
+    phases = {"telegrambot": [], "providers": []}
+    phase = None
+    children = []
+    for line in result.stderr.splitlines():
+        if line in ("providers", "done"):
+            phase = line
+            children = []
+            continue
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 1:
+            children.append((name.strip(), seconds))
+        elif depth == 0:
+            if name.strip() == "telegrambot":
+                phases["telegrambot"] = children
+            elif phase == "providers":
+                phases["providers"].append((name.strip(), seconds))
+            children = []
+    return phases
+
+
+def report_imports(
+    phases: dict[str, list[tuple[str, float]]], min_seconds: float
+) -> None:
+    # modules only appear where they are imported first, so what the provider
+    # SDKs share with the bot is counted for the bot
+    for title, modules in (
+        ("imports before polling", phases["telegrambot"]),
+        ("imports in background ", phases["providers"]),
+    ):
+        total = sum(seconds for _, seconds in modules)
+        print(f"{title}  {total * 1000:7.1f} ms")
+        for name, seconds in sorted(modules, key=lambda m: -m[1]):
+            if seconds >= min_seconds:
+                print(f"  {seconds * 1000:7.1f} ms  {name}")
+
+
+def measure(voice_clip: bytes) -> dict[str, float]:
+    """Seconds from starting the bot until it polls and answers the updates."""
+    api = FakeBotApi().start()
+    google = FakeGoogle().start()
+    openai = FakeOpenAI().start()
+    times = {}
+    done = threading.Event()
+
+    def on_call(method: str, params: dict, at: float):
+        text = params.get("text", "")
+        if method == "getUpdates":
+            times.setdefault("polling", at - started)
+        elif method == "sendMessage" and "/lang" in text:
+            times.setdefault("command", at - started)
+        elif method in ("sendMessage", "editMessageText"):
+            if TRANSLATED in text:
+                times.setdefault("translation", at - started)
+            elif "word0" in text:
+                times.setdefault("transcript", at - started)
+        if {"command", "transcript", "translation"} <= times.keys():
+            done.set()
+
+    api.on_call.append(on_call)
+    # waiting before the bot starts, like the updates that pile up during a
+    # restart
+    api.push(command(1000, 1, "/help"))
+    api.add_file("voice", voice_clip)
+    api.push(voice(1001, 1, "voice", VOICE_SECONDS, len(voice_clip)))
+
+    with tempfile.TemporaryDirectory() as db_dir, tempfile.TemporaryFile() as log:
+        env = {
+            **bot_env(api, db_dir),
+            "SPEECH_API_ENDPOINT": google.address,
+            "TRANSLATE_API_ENDPOINT": google.address,
+            "OPENAI_BASE_URL": openai.url,
+            "METRICS_PORT": "0",
+        }
+        started = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, str(BOT)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+        try:
+            wait_for(done, process, 60)
+        finally:
+            process.terminate()
+            process.wait(10)
+            api.stop()
+            google.stop()
+            openai.stop()
+            log.seek(0)
+            # a warm-up that failed against the fakes would go unnoticed
+            for line in log:
+                if b"warm_up_failed" in line:
+                    print("  " + line.decode().strip())
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--min-ms", type=float, default=5.0, help="hide faster imports")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        report_imports(import_times(db_dir), args.min_ms / 1000)
+
+    voice_clip = clips((VOICE_SECONDS,))[VOICE_SECONDS]
+    runs = [measure(voice_clip) for _ in range(args.runs)]
+    print(f"time to first update, median of {args.runs} runs")
+    for stage in ("polling", "command", "transcript", "translation"):
+        seconds = statistics.median(run[stage] for run in runs)
+        print(f"  {stage:12} {seconds:6.2f} s")
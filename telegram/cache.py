@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Hashable, Optional
+
+
+class LRUCache:
+    """Bounded in-memory mapping that drops the least recently used entry."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key: Hashable, default=None):
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self.entries[key]
+
+    def put(self, key: Hashable, value) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def audio_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class TranscriptionCache:
+    """Transcripts keyed on the audio identity, language codes and model.
+
+    Recent entries stay in memory, all entries are written as one small file
+    each to `directory`. When the files exceed `disk_bytes`, the least recently
+    used ones are deleted (a hit refreshes the file's mtime).
+    """
+
+    def __init__(
+        self, directory: Path, memory_entries: int = 512, disk_bytes: int = 32 << 20
+    ):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.memory = LRUCache(memory_entries)
+        self.disk_bytes = disk_bytes
+        self.disk_lock = threading.Lock()
+        self.used_bytes = sum(f.stat().st_size for f in self.directory.iterdir())
+
+    @staticmethod
+    def key(audio_id: str, language_codes: list[str], model: str) -> str:
+        """`audio_id` is Telegram's file_unique_id or the audio_hash of the data."""
+        identity = json.dumps([audio_id, sorted(language_codes), model])
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        text = self.memory.get(key)
+        if text is None:
+            text = await asyncio.to_thread(self._read, key)
+            if text is not None:
+                self.memory.put(key, text)
+        return text
+
+    async def put(self, key: str, text: str) -> None:
+        self.memory.put(key, text)
+        await asyncio.to_thread(self._write, key, text)
+
+    def _read(self, key: str) -> Optional[str]:
+        path = self.directory.joinpath(key)
+        try:
+            text = path.read_text()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return text
+
+    def _write(self, key: str, text: str) -> None:
+        path = self.directory.joinpath(key)
+        tmp = path.with_suffix(".tmp")
+        with self.disk_lock:
+            tmp.write_text(text)
+            try:
+                self.used_bytes -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            tmp.replace(path)
+            self.used_bytes += path.stat().st_size
+            if self.used_bytes > self.disk_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # drop to 90% so that eviction doesn't run on every write
+        files = sorted(
+            (f.stat().st_mtime, f.stat().st_size, f) for f in self.directory.iterdir()
+        )
+        for _, size, path in files:
+            if self.used_bytes <= self.disk_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            self.used_bytes -= size
+
+
+class TranslationMemory:
+    """Translations of short texts keyed on the normalized text and language pair.
+
+    Lookups hit an LRU first and a SQLite table under db/ second, off the event
+    loop. Rows older than `ttl` seconds are ignored and purged; beyond
+    `max_rows` the oldest are dropped.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        memory_entries: int = 4096,
+        max_rows: int = 100_000,
+        ttl: float = 30 * 24 * 3600,
+        max_length: int = 200,
+        enabled: bool = True,
+    ):
+        self.memory = LRUCache(memory_entries)
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.max_length = max_length
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        # used from the threads of asyncio.to_thread, one at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS translations (
+                source TEXT, target TEXT, text TEXT, translated TEXT, created REAL,
+                PRIMARY KEY (source, target, text)
+            )""")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS translations_created ON translations (created)"
+        )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # case is kept, in German "Sie" and "sie" translate differently
+        return unicodedata.normalize("NFC", " ".join(text.split()))
+
+    async def get(self, text: str, source: str, target: str) -> Optional[str]:
+        if not self.enabled or len(text) > self.max_length:
+            return None
+        key = (self.normalize(text), source, target)
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._read, key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        if entry is None or entry[1] < time.time() - self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    async def put(self, text: str, source: str, target: str, translated: str) -> None:
+        if not self.enabled or len(text) > self.max_length:
+            return
+        key = (self.normalize(text), source, target)
+        entry = (translated, time.time())
+        self.memory.put(key, entry)
+        await asyncio.to_thread(self._write, key, entry)
+
+    def _read(self, key: tuple) -> Optional[tuple]:
+        text, source, target = key
+        with self.lock:
+            return self.conn.execute(
+                "SELECT translated, created FROM translations"
+                " WHERE source = ? AND target = ? AND text = ?",
+                (source, target, text),
+            ).fetchone()
+
+    def _write(self, key: tuple, entry: tuple) -> None:
+        text, source, target = key
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)",
+                (source, target, text, *entry),
+            )
+            self.writes += 1
+        if self.writes % 1000 == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM translations WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self.conn.execute(
+                "DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations"
+                " ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
@@ -0,0 +1,190 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Optional
+
+import metrics
+
+# the provider SDKs take most of the bot's import time, so they are imported in
+# the background by import_providers, while the bot already polls
+if TYPE_CHECKING:
+    import httpx
+    from google.auth.credentials import Credentials
+    from google.cloud.speech_v2 import SpeechAsyncClient
+    from google.cloud.translate_v3 import TranslationServiceAsyncClient
+    from openai import AsyncOpenAI
+
+# regional endpoint for more features for uk-UA
+# https://cloud.google.com/speech-to-text/docs/endpoints
+SPEECH_ENDPOINT = os.environ.get(
+    "SPEECH_API_ENDPOINT", "europe-west4-speech.googleapis.com"
+)
+# the regions recognition may use, preferred first, as "location" or
+# "location=endpoint", e.g. "europe-west4,us-central1"; without it only
+# europe-west4 at SPEECH_ENDPOINT
+# https://cloud.google.com/speech-to-text/v2/docs/speech-to-text-supported-languages
+SPEECH_REGIONS = os.environ.get("SPEECH_REGIONS", "")
+TRANSLATE_ENDPOINT = os.environ.get(
+    "TRANSLATE_API_ENDPOINT", "translate.googleapis.com"
+)
+# plaintext channels without credentials, for local stand-ins of the APIs
+GOOGLE_API_INSECURE = os.environ.get("GOOGLE_API_INSECURE") == "1"
+# https://cloud.google.com/speech-to-text/v2/docs/reference/rest#authorization-scopes
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+def import_providers() -> Optional["Credentials"]:
+    """Import the provider SDKs and load the Google credentials.
+
+    Blocking, meant for a thread; the bot's own imports stay light. Returns the
+    application default credentials, None with GOOGLE_API_INSECURE.
+    https://google-auth.readthedocs.io/en/latest/reference/google.auth.html#google.auth.default
+    """
+    import google.auth
+    import google.cloud.speech_v2  # noqa: F401
+    import google.cloud.speech_v2.types.cloud_speech  # noqa: F401
+    import google.cloud.translate_v3  # noqa: F401
+    import httpx  # noqa: F401
+    import openai  # noqa: F401
+
+    if GOOGLE_API_INSECURE:
+        return None
+    credentials, _ = google.auth.default(scopes=GOOGLE_SCOPES)
+    return credentials
+
+
+def speech_regions() -> list[tuple[str, str]]:
+    """(location, endpoint) of the regions in SPEECH_REGIONS."""
+    if not SPEECH_REGIONS:
+        return [("europe-west4", SPEECH_ENDPOINT)]
+    regions = []
+    for region in SPEECH_REGIONS.split(","):
+        location, _, endpoint = region.strip().partition("=")
+        if not endpoint:
+            endpoint = (
+                "speech.googleapis.com"
+                if location == "global"
+                else f"{location}-speech.googleapis.com"
+            )
+        regions.append((location, endpoint))
+    return regions
+
+
+def speech_client(
+    endpoint: str, credentials: Optional["Credentials"]
+) -> "SpeechAsyncClient":
+    import grpc
+    from google.api_core import client_options
+    from google.cloud.speech_v2 import SpeechAsyncClient
+    from google.cloud.speech_v2.services.speech.transports import (
+        SpeechGrpcAsyncIOTransport,
+    )
+
+    if GOOGLE_API_INSECURE:
+        return SpeechAsyncClient(
+            transport=SpeechGrpcAsyncIOTransport(
+                channel=grpc.aio.insecure_channel(endpoint)
+            )
+        )
+    return SpeechAsyncClient(
+        credentials=credentials,
+        client_options=client_options.ClientOptions(api_endpoint=endpoint),
+    )
+
+
+@dataclass
+class Clients:
+    """Provider clients shared by all handlers.
+
+    The async gRPC clients bind their channel to the running event loop, so they
+    are created on the running loop, after import_providers, and closed on
+    shutdown. `speech` has a client per region, by location. The OpenAI client
+    reads OPENAI_BASE_URL by itself. `http` streams files from Telegram.
+    """
+
+    speech: dict[str, "SpeechAsyncClient"]
+    translate: "TranslationServiceAsyncClient"
+    openai: "AsyncOpenAI"
+    http: "httpx.AsyncClient"
+    credentials: Optional["Credentials"] = None
+
+    @classmethod
+    def create(cls, credentials: Optional["Credentials"]) -> "Clients":
+        import grpc
+        import httpx
+        from google.api_core import client_options
+        from google.cloud.translate_v3 import TranslationServiceAsyncClient
+        from google.cloud.translate_v3.services.translation_service.transports import (
+            TranslationServiceGrpcAsyncIOTransport,
+        )
+        from openai import AsyncOpenAI
+
+        speech = {
+            location: speech_client(endpoint, credentials)
+            for location, endpoint in speech_regions()
+        }
+        if GOOGLE_API_INSECURE:
+            translate = TranslationServiceAsyncClient(
+                transport=TranslationServiceGrpcAsyncIOTransport(
+                    channel=grpc.aio.insecure_channel(TRANSLATE_ENDPOINT)
+                )
+            )
+        else:
+            translate = TranslationServiceAsyncClient(
+                credentials=credentials,
+                client_options=client_options.ClientOptions(
+                    api_endpoint=TRANSLATE_ENDPOINT
+                ),
+            )
+        return cls(
+            speech=speech,
+            translate=translate,
+            openai=AsyncOpenAI(),
+            http=httpx.AsyncClient(timeout=httpx.Timeout(30.0)),
+            credentials=credentials,
+        )
+
+    async def warm_up(self, telegram_api_url: str) -> None:
+        """Connect the channels and pools and fetch an access token, all at once.
+
+        Without it the first voice message pays for the TLS handshakes and the
+        token. A failed step is only logged, the first real request tries again.
+        """
+
+        async def step(name: str, warm: Awaitable) -> None:
+            try:
+                async with metrics.stage("warm_up", name):
+                    await warm
+            except Exception as e:
+                metrics.log("warm_up_failed", provider=name, error=repr(e))
+
+        steps = [
+            step(f"speech_{location}", client.transport.grpc_channel.channel_ready())
+            for location, client in self.speech.items()
+        ]
+        steps.append(
+            step("translate", self.translate.transport.grpc_channel.channel_ready())
+        )
+        # an authenticated request, it also checks the API key
+        steps.append(step("openai", self.openai.models.list()))
+        steps.append(step("telegram_files", self.http.get(telegram_api_url)))
+        if self.credentials is not None:
+            import google.auth.transport.requests
+
+            # the channels reuse the token until it expires
+            # https://google-auth.readthedocs.io/en/latest/reference/google.auth.credentials.html
+            request = google.auth.transport.requests.Request()
+            steps.append(
+                step(
+                    "google_auth",
+                    asyncio.to_thread(self.credentials.refresh, request),
+                )
+            )
+        await asyncio.gather(*steps)
+
+    async def close(self) -> None:
+        for speech in self.speech.values():
+            await speech.transport.close()
+        await self.translate.transport.close()
+        await self.openai.close()
+        await self.http.aclose()
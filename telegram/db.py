@@ -1,21 +1,171 @@
+import asyncio
 import json
+import os
+import sqlite3
+import threading
 from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import metrics
 
 base = Path(__file__).resolve().parent
-db_dir = base.joinpath("db")
+db_dir = Path(os.environ.get("TELEGRAM_DB_DIR", base.joinpath("db")))
 db_dir.mkdir(parents=True, exist_ok=True)
 
 
-def load_db(name: str) -> dict:
-    try:
-        with open(db_dir.joinpath(name + ".json"), "r") as file:
-            content = json.load(file)
-    except FileNotFoundError:
-        content = {}
-    return content
+class Store:
+    """JSON records in db/<name>.sqlite, written one record at a time.
+
+    SQLite in WAL mode keeps every commit atomic and durable, so a crash loses
+    at most the write in progress. The store may be used from several threads.
+    Reads use a connection of their own, in WAL mode they see the last commit
+    without waiting for one in progress.
+    """
+
+    def __init__(self, name: str, directory: Path = db_dir):
+        path = directory.joinpath(name + ".sqlite")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.read_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT value FROM records WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key: str, value: dict) -> None:
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[tuple[str, dict]], **meta: str) -> None:
+        """Write all records and `meta` values in one transaction."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in items),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items()
+            )
+
+    def items(self) -> list[tuple[str, dict]]:
+        with self.read_lock:
+            rows = self.reader.execute("SELECT key, value FROM records").fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM records WHERE key = ?", ((key,) for key in keys)
+            )
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def __len__(self) -> int:
+        with self.read_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+
+class WriteBehind:
+    """Writes records to a store from a worker thread, coalescing bursts.
+
+    `put` only marks the record dirty. Once `delay` seconds passed since the
+    first dirty record, all dirty records are serialized and committed in one
+    transaction. `flush` is the durability barrier: it returns once everything
+    put before it is committed. If a timed flush fails, it's retried with
+    backoff up to `max_delay`.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        serialize: Callable[[Any], dict],
+        delay: float = 1.0,
+        name: str = "store_write",
+        max_delay: float = 60.0,
+    ):
+        self.store = store
+        # the stage the commits are timed as
+        self.name = name
+        self.serialize = serialize
+        self.delay = delay
+        self.max_delay = max_delay
+        # timed flushes that failed in a row
+        self.failures = 0
+        self.dirty: dict[str, Any] = {}
+        self.writing: dict[str, Any] = {}
+        self.timer = None
+        self.tasks = set()
+        self.lock = asyncio.Lock()
+
+    def put(self, key: str, value: Any) -> None:
+        self.dirty[key] = value
+        self._schedule(self.delay)
+
+    def _schedule(self, delay: float) -> None:
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(delay, self._flush_later)
+
+    def pending(self, key: str) -> Any:
+        """The value put for `key` if it isn't committed yet, else None."""
+        return self.dirty.get(key, self.writing.get(key))
+
+    def _flush_later(self) -> None:
+        self.timer = None
+        task = asyncio.create_task(self._flush_or_retry())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush_or_retry(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            # e.g. "database is locked" while two instances share the file
+            self.failures += 1
+            delay = min(self.delay * 2**self.failures, self.max_delay)
+            metrics.log("flush_failed", stage=self.name, error=repr(e), retry=delay)
+            self._schedule(delay)
+
+    async def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # flushes run one after another so that older values never win
+        async with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return
+            self.writing = dirty
+            try:
+                async with metrics.stage(self.name, "sqlite"):
+                    await asyncio.to_thread(self._write, dirty)
+                self.failures = 0
+            except Exception:
+                # keep the records dirty, newer puts take precedence
+                self.dirty = {**dirty, **self.dirty}
+                raise
+            finally:
+                self.writing = {}
 
+    def flush_sync(self) -> None:
+        """Write dirty records from outside the event loop, e.g. at exit."""
+        dirty, self.dirty = self.dirty, {}
+        if dirty:
+            self._write(dirty)
 
-def save_db(name: str, content: dict) -> None:
-    with open(db_dir.joinpath(name + ".json.tmp"), "w") as file:
-        json.dump(content, file, indent=2)
-    db_dir.joinpath(name + ".json.tmp").replace(db_dir.joinpath(name + ".json"))
+    def _write(self, dirty: dict[str, Any]) -> None:
+        self.store.put_many((key, self.serialize(v)) for key, v in dirty.items())
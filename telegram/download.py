@@ -0,0 +1,42 @@
+import mmap
+from contextlib import contextmanager
+from pathlib import Path
+
+import httpx
+
+CHUNK_BYTES = 64 * 1024
+
+
+async def download_to_file(http: httpx.AsyncClient, url: str, path: Path) -> int:
+    """Stream a file to disk chunk by chunk, returns its size.
+
+    Unlike File.download_to_drive, which holds the whole file in memory before
+    writing it, at most one chunk is in memory at a time.
+    """
+    size = 0
+    async with http.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            # small writes into the page cache, they don't block noticeably
+            async for chunk in response.aiter_bytes(CHUNK_BYTES):
+                size += file.write(chunk)
+    return size
+
+
+@contextmanager
+def mapped(path: Path):
+    """The file's content as a read-only memoryview, without reading it.
+
+    The pages are loaded on access and belong to the page cache, the view is
+    released when the block ends.
+    """
+    with open(path, "rb") as file:
+        if Path(path).stat().st_size == 0:
+            yield memoryview(b"")
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                yield view
+            finally:
+                view.release()
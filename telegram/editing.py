@@ -0,0 +1,126 @@
+import asyncio
+import time
+from typing import Optional
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+
+def split(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    """`text` in parts that fit in a message, cut between words if possible."""
+    parts = []
+    while len(text) > limit:
+        cut = max(text.rfind(" ", 0, limit + 1), text.rfind("\n", 0, limit + 1))
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    return parts + [text]
+
+
+class MessageEditor:
+    """Shows changing text in one bot message without exceeding Telegram's edit rate.
+
+    `update` only remembers the newest text; a background task edits the message
+    at most every `interval` seconds with whatever text is newest by then. The
+    message can be attached later, updates before that are shown once it is.
+    Text longer than a message continues in replies to it.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        message_id: Optional[int] = None,
+        interval: float = 1.0,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.text = None
+        self.shown = None
+        self.last_edit = 0.0
+        self.task = None
+        # the replies the text continues in, and the parts shown in all messages
+        self.more_ids: list[int] = []
+        self.shown_parts: list[str] = []
+
+    def attach(self, message_id: int) -> None:
+        self.message_id = message_id
+        if self.text is not None:
+            self._set(self.text)
+
+    def update(self, text: str) -> None:
+        if text.strip():
+            self._set(text)
+
+    async def close(self, text: str) -> None:
+        """Show the final text and wait until it is visible."""
+        self._set(text)
+        if self.task is not None:
+            await self.task
+
+    async def fail(self, text: str = "✘") -> None:
+        """Drop pending updates and show `text` instead."""
+        if self.task is not None:
+            self.task.cancel()
+        self.text = self.shown = text
+        await self.bot.edit_message_text(
+            chat_id=self.chat_id, message_id=self.message_id, text=text
+        )
+
+    def _set(self, text: str) -> None:
+        self.text = text
+        if self.message_id is None:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self.text != self.shown:
+            await asyncio.sleep(self.last_edit + self.interval - time.monotonic())
+            text = self.text
+            self.last_edit = time.monotonic()
+            try:
+                await self._show(split(text))
+            except RetryAfter as e:
+                # flood control, retry with the newest text once it's over
+                self.last_edit = time.monotonic() + e.retry_after - self.interval
+                continue
+            self.shown = text
+
+    async def _show(self, parts: list[str]) -> None:
+        for i, part in enumerate(parts):
+            if i < len(self.shown_parts) and self.shown_parts[i] == part:
+                continue
+            text = f"<blockquote>{part}</blockquote>"
+            if i == 0 or i <= len(self.more_ids):
+                message_id = self.message_id if i == 0 else self.more_ids[i - 1]
+                try:
+                    await self.bot.edit_message_text(
+                        chat_id=self.chat_id,
+                        message_id=message_id,
+                        text=text,
+                        parse_mode="HTML",
+                    )
+                except BadRequest as e:
+                    if "not modified" not in e.message:
+                        raise
+            else:
+                message = await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=text,
+                    parse_mode="HTML",
+                    reply_to_message_id=self.message_id,
+                )
+                self.more_ids.append(message.message_id)
+            if i < len(self.shown_parts):
+                self.shown_parts[i] = part
+            else:
+                self.shown_parts.append(part)
+        # the text got shorter, e.g. a partial result was corrected
+        while len(self.more_ids) >= len(parts):
+            await self.bot.delete_message(self.chat_id, self.more_ids.pop())
+        del self.shown_parts[len(parts) :]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Replaces the running bot by a new instance without a gap in the updates. The
+# bot runs as telegrambot@<slot>: the slot that isn't running starts, and once
+# its /healthz reports it ready, the running one is stopped and drains its
+# voice messages while the new one takes the updates. If the new one doesn't
+# get ready it's stopped again and the old one keeps running. Runs on the
+# server, with the slots and their health ports as in deploy.py:
+#
+#   python handoff.py blue=9464 green=9465
+#
+# https://www.freedesktop.org/software/systemd/man/latest/systemctl.html
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Optional
+
+# the unit from before the slots, it has the first slot's ports
+LEGACY_UNIT = "telegrambot"
+# what a deploy may take from the users, reported when exceeded
+MAX_GAP_SECONDS = 1.0
+
+
+def systemctl(*args: str, check: bool = True) -> str:
+    return subprocess.run(
+        ["systemctl", *args], capture_output=True, text=True, check=check
+    ).stdout.strip()
+
+
+def is_running(unit: str, stopping: bool = False) -> bool:
+    states = ("active", "activating") + (("deactivating",) if stopping else ())
+    return systemctl("is-active", unit, check=False) in states
+
+
+def health(port: int) -> Optional[dict]:
+    try:
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{port}/healthz", timeout=1
+        ) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        # starting or draining
+        return json.load(e)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for(port: int, ready, timeout: float) -> Optional[dict]:
+    """The first health status that `ready` accepts, None on timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = health(port)
+        if status is not None and ready(status):
+            return status
+        time.sleep(0.05)
+    return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("slots", nargs=2, help="slot=health port, e.g. blue=9464")
+    parser.add_argument("--ready-timeout", type=float, default=60)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    args = parser.parse_args()
+    ports = {slot: int(port) for slot, port in (arg.split("=") for arg in args.slots)}
+    units = {slot: f"telegrambot@{slot}" for slot in ports}
+
+    old = next((slot for slot in ports if is_running(units[slot])), None)
+    if old is not None:
+        old_unit = units[old]
+        new = next(slot for slot in ports if slot != old)
+    elif is_running(LEGACY_UNIT):
+        old_unit = LEGACY_UNIT
+        new = list(ports)[1]
+    else:
+        old_unit = None
+        new = list(ports)[0]
+    new_unit = units[new]
+
+    print(f"starting {new_unit}")
+    systemctl("reset-failed", new_unit, check=False)
+    systemctl("start", new_unit)
+    started = time.monotonic()
+    ready = wait_for(
+        ports[new], lambda s: s["state"] in ("standby", "serving"), args.ready_timeout
+    )
+    if ready is None:
+        print(systemctl("status", "--no-pager", "--lines=30", new_unit, check=False))
+        systemctl("stop", new_unit, check=False)
+        print(f"{new_unit} didn't get ready, {old_unit or 'no instance'} keeps running")
+        return 1
+    print(f"{new_unit} ready after {time.monotonic() - started:.1f} s")
+
+    if old_unit is not None:
+        # SIGTERM, the old instance stops taking updates and drains meanwhile
+        systemctl("stop", "--no-block", old_unit)
+    # the gap is known once the old slot stopped taking updates; the legacy
+    # unit doesn't note when
+    measured = old is not None
+    status = wait_for(
+        ports[new],
+        lambda s: s["state"] == "serving"
+        and (not measured or s["handoff_gap_seconds"] is not None),
+        args.ready_timeout,
+    )
+    if status is None:
+        print(systemctl("status", "--no-pager", "--lines=30", new_unit, check=False))
+        print(f"{new_unit} didn't take over the updates")
+        return 1
+    systemctl("enable", new_unit)
+    if old_unit is not None:
+        systemctl("disable", old_unit, check=False)
+        if measured:
+            gap = status["handoff_gap_seconds"]
+            print(f"{old_unit} -> {new_unit}, {gap * 1000:.0f} ms without updates")
+            if gap > MAX_GAP_SECONDS:
+                print(f"the gap was above {MAX_GAP_SECONDS} s")
+
+        started = time.monotonic()
+        while is_running(old_unit, stopping=True):
+            if time.monotonic() - started > args.drain_timeout:
+                print(f"{old_unit} still drains")
+                break
+            time.sleep(0.2)
+        else:
+            print(f"{old_unit} drained in {time.monotonic() - started:.1f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
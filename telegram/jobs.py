@@ -0,0 +1,102 @@
+import asyncio
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from db import Store, db_dir
+
+# Telegram redelivers an update for up to 24 hours until it's confirmed
+# https://core.telegram.org/bots/api#getting-updates
+FINISHED_RETENTION = 24 * 60 * 60
+
+
+@dataclass
+class VoiceJob:
+    """A voice message in processing, with the results of its finished stages.
+
+    Everything needed to continue is captured when the message arrives, so a
+    resumed job neither needs the update nor the chat's current config.
+    """
+
+    update_id: int
+    chat_id: int
+    file_id: str
+    file_unique_id: str
+    duration: int
+    from_language: str
+    to_language: str
+    suggesting: bool
+    created: float = 0.0
+    finished: Optional[float] = None
+    transcript_message_id: Optional[int] = None
+    audio_path: Optional[str] = None
+    transcript: Optional[str] = None
+    translate_message_id: Optional[int] = None
+    translation: Optional[str] = None
+    suggest_message_id: Optional[int] = None
+    suggestion: Optional[str] = None
+
+
+class VoiceJobs:
+    """Voice jobs in db/jobs.sqlite, keyed by update id.
+
+    Every checkpoint is committed before the next stage starts, so after a
+    restart `unfinished` jobs continue with the first stage that has no result
+    yet. Finished jobs are kept for a day, so a redelivered update isn't
+    processed twice.
+    """
+
+    def __init__(self, store: Store, audio_dir: Path = db_dir.joinpath("jobs")):
+        self.store = store
+        self.audio_dir = audio_dir
+        self.audio_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = asyncio.Lock()
+
+    async def create(self, job: VoiceJob) -> bool:
+        """Persist a new job, False if the update was seen already."""
+        async with self.lock:
+            if await asyncio.to_thread(self.store.get, str(job.update_id)):
+                return False
+            job.created = time.time()
+            await asyncio.to_thread(self.store.put, str(job.update_id), asdict(job))
+        return True
+
+    async def save(self, job: VoiceJob) -> None:
+        # serialized here, the job may change while the thread writes
+        value = asdict(job)
+        async with self.lock:
+            await asyncio.to_thread(self.store.put, str(job.update_id), value)
+
+    async def stage(
+        self, job: VoiceJob, name: str, run: Callable[[], Awaitable[str]]
+    ) -> str:
+        """The checkpointed result of a stage, running it only if there is none."""
+        value = getattr(job, name)
+        if value is None:
+            value = await run()
+            setattr(job, name, value)
+            await self.save(job)
+        return value
+
+    def audio_path(self, job: VoiceJob) -> Path:
+        return self.audio_dir.joinpath(f"{job.update_id}.ogg")
+
+    async def finish(self, job: VoiceJob) -> None:
+        job.finished = time.time()
+        await self.save(job)
+        if job.audio_path is not None:
+            Path(job.audio_path).unlink(missing_ok=True)
+
+    def unfinished(self) -> list[VoiceJob]:
+        """Jobs interrupted by a restart, oldest first. Prunes finished ones."""
+        jobs = [VoiceJob(**value) for _, value in self.store.items()]
+        expired = time.time() - FINISHED_RETENTION
+        self.store.delete_many(
+            str(job.update_id)
+            for job in jobs
+            if job.finished is not None and job.finished < expired
+        )
+        return sorted(
+            (job for job in jobs if job.finished is None), key=lambda j: j.update_id
+        )
@@ -0,0 +1,82 @@
+import json
+from typing import Iterator, TextIO
+
+WHITESPACE = " \t\n\r"
+
+
+class JsonStream:
+    """Reads a JSON document member by member with a buffer of bounded size.
+
+    `keys` iterates the members of the object at the current position. After
+    each key, the caller reads the member's value with `value` or, for nested
+    objects, with another `keys` loop, before asking for the next key.
+    """
+
+    def __init__(self, file: TextIO, chunk_size: int = 1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def keys(self) -> Iterator[str]:
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"expected a key, got {key!r}")
+            self._expect(":")
+            yield key
+            separator = self._peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"expected ',' or '}}', got {separator!r}")
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"expected {char!r}, got {found!r}")
+        self.pos += 1
+
+    def _peek(self) -> str:
+        """The next non-whitespace character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what was read already
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
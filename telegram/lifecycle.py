@@ -0,0 +1,119 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+import metrics
+from tornado.web import RequestHandler
+
+handoff_gap = metrics.Gauge(
+    "bot_handoff_gap_seconds",
+    "Time no instance took updates while this one replaced the previous one.",
+)
+metrics.registry.append(handoff_gap)
+
+
+class FileLock:
+    """An exclusive flock on `path`.
+
+    The kernel releases it when the process exits, however it exits, so a
+    crashed instance doesn't block the next one.
+    https://man7.org/linux/man-pages/man2/flock.2.html
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+
+    async def acquire(
+        self, until: Optional[asyncio.Event] = None, interval: float = 0.01
+    ) -> bool:
+        """Wait for the lock, False if `until` is set before it's free."""
+        file = open(self.path, "a")
+        while True:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.file = file
+                return True
+            except BlockingIOError:
+                # a blocking flock in a thread couldn't be cancelled
+                if until is not None and until.is_set():
+                    file.close()
+                    return False
+                await asyncio.sleep(interval)
+
+    def release(self) -> None:
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class Health:
+    """Where this instance is in its life, for a deploy handing over to it.
+
+    starting, standby (ready, waiting for the previous instance to stop taking
+    updates), serving, draining. The previous instance notes in `handoff_path`
+    when it stopped taking updates, the gap is measured from there. Only an
+    instance that stops after this one started counts as the previous one.
+    """
+
+    def __init__(self, handoff_path: Path):
+        self.handoff_path = handoff_path
+        self.state = "starting"
+        self.started = time.time()
+        self.serving_since: Optional[float] = None
+        self.gap: Optional[float] = None
+        self.previous_pid: Optional[int] = None
+
+    def serve(self) -> None:
+        self.state = "serving"
+        self.serving_since = time.time()
+
+    def stop_serving(self) -> None:
+        if self.state == "serving":
+            self.handoff_path.write_text(
+                json.dumps({"stopped_at": time.time(), "pid": os.getpid()})
+            )
+        self.state = "draining"
+
+    def measure_gap(self) -> Optional[float]:
+        """Seconds between the previous instance's last and this one's first
+        update, 0 if they overlapped. None until both happened."""
+        if self.gap is None and self.serving_since is not None:
+            try:
+                handoff = json.loads(self.handoff_path.read_text())
+            except (OSError, ValueError):
+                return None
+            # written by an instance this one didn't replace, or by itself
+            if handoff["stopped_at"] < self.started or handoff["pid"] == os.getpid():
+                return None
+            self.gap = max(self.serving_since - handoff["stopped_at"], 0.0)
+            self.previous_pid = handoff["pid"]
+            handoff_gap.set(value=self.gap)
+        return self.gap
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "pid": os.getpid(),
+            "started": self.started,
+            "serving_since": self.serving_since,
+            "handoff_gap_seconds": self.measure_gap(),
+            "previous_pid": self.previous_pid,
+        }
+
+
+class HealthHandler(RequestHandler):
+    """/healthz, 200 when the instance takes or is ready to take updates."""
+
+    def initialize(self, health: Health):
+        self.health = health
+
+    def get(self):
+        if self.health.state not in ("standby", "serving"):
+            self.set_status(503)
+        self.write(self.health.status())
@@ -0,0 +1,217 @@
+import functools
+import json
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable
+
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+# ties the log lines of an update together, the update id or "-"
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+
+# seconds, up to the minute a long recognition may take
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def number(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Metric:
+    """Values of a metric by label values, in Prometheus' text format.
+
+    https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+    """
+
+    def __init__(self, name: str, kind: str, help: str, labels: tuple[str, ...]):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [
+            f'{name}="{escape(value)}"' for name, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, "counter", help, labels)
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] += amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{self._labels(labels)} {number(value)}"
+
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.kind = "gauge"
+
+    def set(self, *labels, value: float) -> None:
+        self.values[labels] = value
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.values[labels] -= amount
+
+
+class Histogram(Metric):
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ):
+        super().__init__(name, "histogram", help, labels)
+        self.buckets = buckets
+        # per label values: counts per bucket and +Inf, then the sum
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._labels(labels, le)} {total}"
+            yield f"{self.name}_sum{self._labels(labels)} {number(counts[-1])}"
+            yield f"{self.name}_count{self._labels(labels)} {total}"
+
+
+stage_seconds = Histogram(
+    "bot_stage_seconds", "Duration of pipeline stages.", ("stage", "provider")
+)
+stage_in_flight = Gauge(
+    "bot_stage_in_flight", "Pipeline stages running.", ("stage", "provider")
+)
+stage_errors = Counter(
+    "bot_stage_errors_total",
+    "Pipeline stages that failed.",
+    ("stage", "provider", "error"),
+)
+updates = Counter("bot_updates_total", "Updates received.", ("kind",))
+audio_bytes = Counter(
+    "bot_audio_bytes_total", "Audio downloaded and uploaded.", ("direction",)
+)
+audio_seconds = Counter(
+    "bot_audio_seconds_total",
+    "Audio received and sent to recognition after preprocessing.",
+    ("kind",),
+)
+registry: list[Metric] = [
+    stage_seconds,
+    stage_in_flight,
+    stage_errors,
+    updates,
+    audio_bytes,
+    audio_seconds,
+]
+# called on every scrape for values kept elsewhere, like queue depths
+collectors: list[Callable[[], Iterable[Metric]]] = []
+
+
+def render() -> str:
+    metrics = [*registry]
+    for collect in collectors:
+        metrics.extend(collect())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+@asynccontextmanager
+async def stage(name: str, provider: str):
+    """Time the block as a stage, counting it as in flight meanwhile."""
+    started = time.perf_counter()
+    stage_in_flight.inc(name, provider)
+    try:
+        yield
+    except Exception as e:
+        stage_errors.inc(name, provider, type(e).__name__)
+        log("stage", stage=name, provider=provider, error=repr(e))
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        stage_in_flight.dec(name, provider)
+        stage_seconds.observe(seconds, name, provider)
+    log("stage", stage=name, provider=provider, seconds=round(seconds, 4))
+
+
+def timed(name: str, provider: str = "bot"):
+    """Decorator timing an async function as a stage."""
+
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            async with stage(name, provider):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def log(event: str, **fields) -> None:
+    """Write a JSON log line for `event` with the current correlation id."""
+    logger.info(event, extra={"fields": fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the correlation id of the update."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "id": correlation_id.get(),
+            "event": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+logger = logging.getLogger("bot")
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+def serve(port: int, address: str = "127.0.0.1", handlers: list = []) -> HTTPServer:
+    """Serve /metrics on the running event loop, for Prometheus to scrape, and
+    the tornado `handlers` next to it."""
+    return Application([("/metrics", MetricsHandler), *handlers]).listen(port, address)
@@ -1,8 +1,17 @@
-from dataclasses import dataclass, field
-from typing import Dict
+from array import array
+from bisect import bisect_left
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, Optional, TextIO
 
+from db import Store, WriteBehind, db_dir
+from jsonstream import JsonStream
 
-@dataclass
+# https://cloud.google.com/speech-to-text/v2/docs/speech-to-text-supported-languages
+LANGUAGE_CODES = ("de-DE", "en-US", "uk-UA")
+
+
+@dataclass(slots=True)
 class ChatConfig:
     trainer_language: str = "de-DE"
     learner_language: str = "en-US"
@@ -10,39 +19,254 @@ class ChatConfig:
     trainer_id: int = -1
 
 
+class Chats:
+    """Chat configs by chat id, packed into arrays sorted by chat id.
+
+    Chats with the default config take no memory. Others are read from the store
+    on first access and, beyond `max_resident` chats, the least recently used
+    are dropped again. A chat costs about 30 bytes while in memory, languages
+    are kept as indices into LANGUAGE_CODES. The ids of up to `max_defaults`
+    chats that turned out to have the default config are remembered, so that
+    their messages don't each read the store on the event loop. `save` writes a
+    single chat through the write-behind `persister`.
+    """
+
+    def __init__(
+        self,
+        store: Optional[Store] = None,
+        write_delay: float = 1.0,
+        max_resident: int = 100_000,
+        max_defaults: int = 10_000,
+    ):
+        self.store = store
+        self.max_resident = max_resident
+        self.max_defaults = max_defaults
+        # in the order they were last used, a dict keeps it
+        self.defaults: dict[int, None] = {}
+        self.ids = array("q")
+        self.trainer_languages = array("B")
+        self.learner_languages = array("B")
+        self.suggestions = array("B")
+        self.trainer_ids = array("q")
+        self.last_used = array("Q")
+        self.clock = 0
+        if store is not None:
+            self.persister = WriteBehind(
+                store, asdict, delay=write_delay, name="config_save"
+            )
+
+    def get(self, chat_id: int) -> ChatConfig:
+        """A copy of the chat's config, pass it to `save` after changing it."""
+        row = self._row(chat_id)
+        if row < 0:
+            if chat_id in self.defaults:
+                del self.defaults[chat_id]
+                self.defaults[chat_id] = None
+                return ChatConfig()
+            chat = self._load(chat_id)
+            if chat != ChatConfig():
+                self._insert(chat_id, chat)
+            else:
+                self._remember_default(chat_id)
+            return chat
+        self.clock += 1
+        self.last_used[row] = self.clock
+        return ChatConfig(
+            trainer_language=LANGUAGE_CODES[self.trainer_languages[row]],
+            learner_language=LANGUAGE_CODES[self.learner_languages[row]],
+            suggestions=bool(self.suggestions[row]),
+            trainer_id=self.trainer_ids[row],
+        )
+
+    def save(self, chat_id: int, chat: ChatConfig) -> None:
+        row = self._row(chat_id)
+        if row >= 0:
+            self._delete([row])
+        self.defaults.pop(chat_id, None)
+        if chat != ChatConfig():
+            self._insert(chat_id, chat)
+        else:
+            self._remember_default(chat_id)
+        # a copy, the caller may go on changing `chat`
+        self.persister.put(str(chat_id), ChatConfig(**asdict(chat)))
+
+    def _load(self, chat_id: int) -> ChatConfig:
+        chat = None
+        if self.store is not None:
+            # a copy, the pending one is serialized by the writer thread
+            record = self.persister.pending(str(chat_id))
+            if record is not None:
+                record = asdict(record)
+            else:
+                record = self.store.get(str(chat_id))
+            chat = None if record is None else ChatConfig(**record)
+        return ChatConfig() if chat is None else chat
+
+    def _remember_default(self, chat_id: int) -> None:
+        self.defaults[chat_id] = None
+        if len(self.defaults) > self.max_defaults:
+            del self.defaults[next(iter(self.defaults))]
+
+    def _row(self, chat_id: int) -> int:
+        row = bisect_left(self.ids, chat_id)
+        if row < len(self.ids) and self.ids[row] == chat_id:
+            return row
+        return -1
+
+    def _insert(self, chat_id: int, chat: ChatConfig) -> None:
+        row = bisect_left(self.ids, chat_id)
+        self.clock += 1
+        self.ids.insert(row, chat_id)
+        self.trainer_languages.insert(row, LANGUAGE_CODES.index(chat.trainer_language))
+        self.learner_languages.insert(row, LANGUAGE_CODES.index(chat.learner_language))
+        self.suggestions.insert(row, chat.suggestions)
+        self.trainer_ids.insert(row, chat.trainer_id)
+        self.last_used.insert(row, self.clock)
+        if len(self.ids) > self.max_resident:
+            # drop the least recently used tenth, they're still in the store
+            threshold = sorted(self.last_used)[len(self.ids) // 10]
+            self._delete([i for i, t in enumerate(self.last_used) if t < threshold])
+
+    def _delete(self, rows: list[int]) -> None:
+        columns = (
+            self.ids,
+            self.trainer_languages,
+            self.learner_languages,
+            self.suggestions,
+            self.trainer_ids,
+            self.last_used,
+        )
+        for column in columns:
+            for row in reversed(rows):
+                del column[row]
+
+    def __repr__(self) -> str:
+        stored = 0 if self.store is None else len(self.store)
+        return f"Chats({stored} stored, {len(self.ids)} resident)"
+
+
 @dataclass
 class Database:
     version: int = 3
-    chats: Dict[int, ChatConfig] = field(default_factory=dict)
-
-
-def migrate(serialized: dict) -> Database:
-    # empty
-    if len(serialized) == 0:
-        db = Database()
-        return db
-
-    # v1 => v2
-    if "trainer_language" in serialized:
-        serialized = {
-            "version": 2,
-            "chats": {},
-            "default": {
-                "trainer_language": serialized["trainer_language"],
-                "learner_language": serialized["learner_language"],
-            },
-        }
-
-    # v2 => v3
-    if serialized["version"] == 2:
-        serialized["version"] = 3
-        del serialized["default"]
-        for chat in serialized["chats"].values():
-            chat["suggestions"] = False
-
-    # v3
-    db = Database(
-        version=serialized["version"],
-        chats={int(k): ChatConfig(**v) for k, v in serialized["chats"].items()},
-    )
-    return db
+    chats: Chats = field(default_factory=Chats)
+
+
+def load_database(store: Store, write_delay: float = 1.0) -> Database:
+    """Open the chat configs in `store`, importing db/config.json on first use."""
+    version = store.get_meta("version")
+    if version is None:
+        legacy_path = db_dir.joinpath("config.json")
+        if legacy_path.exists():
+            version = migrate_file(legacy_path, store)
+            legacy_path.replace(db_dir.joinpath("config.json.imported"))
+        else:
+            version = CURRENT_VERSION
+            store.put_many([], version=str(version))
+    return Database(version=int(version), chats=Chats(store, write_delay))
+
+
+# Migrations from the serialized config.json format. The step registered for
+# version n turns a version n file into a version n + 1 file, once for the
+# top-level members except chats (`header`) and once per chat (`chat`).
+
+
+@dataclass
+class Migration:
+    header: Callable[[dict], dict]
+    chat: Callable[[dict], dict] = lambda chat: chat
+
+
+def v1_header(header: dict) -> dict:
+    # v1 had a single language pair for all chats
+    return {
+        "version": 2,
+        "default": {
+            "trainer_language": header["trainer_language"],
+            "learner_language": header["learner_language"],
+        },
+    }
+
+
+def v2_header(header: dict) -> dict:
+    header = {k: v for k, v in header.items() if k != "default"}
+    header["version"] = 3
+    return header
+
+
+def v2_chat(chat: dict) -> dict:
+    return {**chat, "suggestions": False}
+
+
+MIGRATIONS = {
+    1: Migration(header=v1_header),
+    2: Migration(header=v2_header, chat=v2_chat),
+}
+CURRENT_VERSION = 3
+
+
+def file_version(header: dict) -> int:
+    if len(header) == 0:
+        return CURRENT_VERSION
+    if "trainer_language" in header:
+        return 1
+    return header["version"]
+
+
+def migrate_header(header: dict) -> dict:
+    for version in range(file_version(header), CURRENT_VERSION):
+        header = MIGRATIONS[version].header(header)
+    return header
+
+
+def migrate_chat(chat: dict, version: int) -> dict:
+    for version in range(version, CURRENT_VERSION):
+        chat = MIGRATIONS[version].chat(chat)
+    return chat
+
+
+def read_header(file: TextIO) -> dict:
+    """Top-level members of a serialized config, skipping over the chats."""
+    stream = JsonStream(file)
+    header = {}
+    for key in stream.keys():
+        if key == "chats":
+            for _ in stream.keys():
+                stream.value()
+        else:
+            header[key] = stream.value()
+    return header
+
+
+def read_chats(file: TextIO) -> Iterator[tuple[str, dict]]:
+    stream = JsonStream(file)
+    for key in stream.keys():
+        if key == "chats":
+            for chat_id in stream.keys():
+                yield chat_id, stream.value()
+        else:
+            stream.value()
+
+
+def migrate_file(path: Path, store: Store, batch_size: int = 10_000) -> int:
+    """Migrate a serialized config into `store` one chat at a time.
+
+    The file is read twice, first for the version and then for the chats, so
+    memory use doesn't depend on its size. Chats are written in transactions of
+    `batch_size`, the version last, so an interrupted migration is redone.
+    """
+    with open(path) as file:
+        header = read_header(file)
+    version = file_version(header)
+    header = migrate_header(header)
+    header.setdefault("version", CURRENT_VERSION)
+
+    with open(path) as file:
+        batch = []
+        for chat_id, chat in read_chats(file):
+            chat = asdict(ChatConfig(**migrate_chat(chat, version)))
+            batch.append((chat_id, chat))
+            if len(batch) == batch_size:
+                store.put_many(batch)
+                batch = []
+    store.put_many(batch, version=str(header["version"]))
+    return header["version"]
@@ -0,0 +1,264 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Generic, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+C = TypeVar("C")
+
+hedges = metrics.Counter(
+    "bot_hedged_requests_total",
+    "Backup requests sent to another endpoint, by whether they won.",
+    ("endpoint", "outcome"),
+)
+retries = metrics.Counter(
+    "bot_retried_requests_total", "Requests retried after an error.", ("endpoint",)
+)
+breaker_opened = metrics.Counter(
+    "bot_circuit_opened_total", "Circuit breakers that opened.", ("endpoint",)
+)
+metrics.registry.extend([hedges, retries, breaker_opened])
+
+
+class LatencyTracker:
+    """Recent latencies of an endpoint, per unit of work (e.g. audio second).
+
+    Requests differ in size, so the latency is divided by the request's units
+    and scaled back for the request at hand.
+    """
+
+    def __init__(self, window: int = 200, default: float = 1.0, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.default = default
+        self.min_samples = min_samples
+        # exponentially weighted mean, for ranking endpoints
+        self.mean: Optional[float] = None
+
+    def record(self, seconds: float, units: float) -> None:
+        per_unit = seconds / max(units, 1.0)
+        self.samples.append(per_unit)
+        self.mean = per_unit if self.mean is None else 0.8 * self.mean + 0.2 * per_unit
+
+    def percentile(self, p: float, units: float) -> float:
+        if len(self.samples) < self.min_samples:
+            return self.default * max(units, 1.0)
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] * max(units, 1.0)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` errors in a row, lets a trial through after
+    `cooldown` seconds and closes again when it succeeds."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def available(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # half-open: one request at a time tests the endpoint
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self) -> bool:
+        """Count an error, True if the breaker opened because of it."""
+        self.failures += 1
+        if self.failures >= self.threshold and self.opened_at is None:
+            self.opened_at = time.monotonic()
+            return True
+        if self.opened_at is not None:
+            # the half-open trial failed
+            self.opened_at = time.monotonic()
+        return False
+
+
+class RetryBudget:
+    """Allows retries and hedges for at most `ratio` of the requests.
+
+    Every request adds `ratio` tokens, every retry or hedge takes one, so
+    extra requests can't pile onto an endpoint that is already struggling.
+    `minimum` tokens per second keep a quiet bot able to retry.
+    """
+
+    def __init__(self, ratio: float = 0.1, minimum: float = 1.0, cap: float = 10.0):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.cap = cap
+        self.tokens = cap
+        self.updated = time.monotonic()
+
+    def _refill(self, tokens: float) -> None:
+        now = time.monotonic()
+        tokens += (now - self.updated) * self.minimum
+        self.updated = now
+        self.tokens = min(self.tokens + tokens, self.cap)
+
+    def request(self) -> None:
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill(0)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Endpoint(Generic[C]):
+    def __init__(self, name: str, client: C):
+        self.name = name
+        self.client = client
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+
+
+class Router(Generic[C]):
+    """Sends a request to the fastest available endpoint, hedging and retrying.
+
+    Once the request is slower than that endpoint's p95, a backup goes to the
+    next endpoint and whichever answers first wins. Errors that `retryable`
+    accepts are retried on the next endpoint after a jittered backoff. Both
+    draw from one RetryBudget, so the extra requests stay a small share.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint[C]],
+        retryable: Callable[[Exception], bool],
+        hedging: bool = True,
+        hedge_percentile: float = 0.95,
+        attempts: int = 3,
+        backoff: float = 0.2,
+        budget: Optional[RetryBudget] = None,
+    ):
+        self.endpoints = endpoints
+        self.retryable = retryable
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.attempts = attempts
+        self.backoff = backoff
+        self.budget = budget or RetryBudget()
+
+    def ranked(self) -> list[Endpoint[C]]:
+        """Available endpoints, the fastest first; all of them if none is.
+
+        Endpoints without samples keep their configured order behind the
+        others, they get some from hedges."""
+        available = [e for e in self.endpoints if e.breaker.available()]
+        unknown = float("inf")
+        return sorted(
+            available or self.endpoints,
+            key=lambda e: unknown if e.latency.mean is None else e.latency.mean,
+        )
+
+    async def _attempt(
+        self,
+        endpoint: Endpoint[C],
+        call: Callable[[Endpoint[C]], Awaitable[T]],
+        units: float,
+    ) -> T:
+        started = time.monotonic()
+        try:
+            result = await call(endpoint)
+        except asyncio.CancelledError:
+            # lost to a hedge: it took at least this long, which keeps the
+            # tail of a slow endpoint in its percentiles
+            endpoint.latency.record(time.monotonic() - started, units)
+            raise
+        except Exception as e:
+            if self.retryable(e) and endpoint.breaker.failed():
+                breaker_opened.inc(endpoint.name)
+                metrics.log("circuit_opened", endpoint=endpoint.name, error=repr(e))
+            raise
+        endpoint.latency.record(time.monotonic() - started, units)
+        endpoint.breaker.succeeded()
+        return result
+
+    async def call(
+        self,
+        call: Callable[[Endpoint[C]], Awaitable[T]],
+        units: float = 1.0,
+        hedge: bool = True,
+    ) -> T:
+        """The result of `call` on the first endpoint that answers.
+
+        `units` is the size of the request, e.g. seconds of audio. Calls that
+        can't run twice, like streams reporting partial results, pass
+        hedge=False and are only retried.
+        """
+        self.budget.request()
+        ranked = self.ranked()
+        running: dict[asyncio.Task, Endpoint[C]] = {}
+        tried = 0
+        error: Optional[Exception] = None
+
+        def start(endpoint: Endpoint[C]) -> None:
+            nonlocal tried
+            tried += 1
+            task = asyncio.create_task(self._attempt(endpoint, call, units))
+            running[task] = endpoint
+
+        start(ranked[0])
+        hedge = hedge and self.hedging and len(ranked) > 1
+        try:
+            while running:
+                timeout = None
+                if hedge:
+                    primary = ranked[0]
+                    timeout = primary.latency.percentile(self.hedge_percentile, units)
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # slower than usual, race a backup against it
+                    hedge = False
+                    if self.budget.withdraw():
+                        backup = ranked[tried % len(ranked)]
+                        hedges.inc(backup.name, "sent")
+                        start(backup)
+                    continue
+                for task in done:
+                    endpoint = running.pop(task)
+                    if task.exception() is None:
+                        if endpoint is not ranked[0]:
+                            hedges.inc(endpoint.name, "won")
+                        return task.result()
+                    error = task.exception()
+                if running:
+                    continue
+                # nothing left in flight, retry the error on the next endpoint
+                if (
+                    not self.retryable(error)
+                    or tried >= self.attempts
+                    or not self.budget.withdraw()
+                ):
+                    raise error
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (tried - 1)))
+                endpoint = ranked[tried % len(ranked)]
+                retries.inc(endpoint.name)
+                start(endpoint)
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            endpoint.name: {
+                "p95_seconds_per_unit": round(endpoint.latency.percentile(0.95, 1), 3),
+                "open": endpoint.breaker.opened_at is not None,
+            }
+            for endpoint in self.endpoints
+        }
@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+
+class Busy(Exception):
+    """The job was rejected because too many are waiting already."""
+
+
+class Draining(Exception):
+    """The job didn't start because the scheduler was closed."""
+
+
+class Limit:
+    """Semaphore that keeps track of its waiters, holders and waiting time."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.semaphore = asyncio.Semaphore(size)
+        self.waiting = 0
+        self.running = 0
+        self.acquired = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self._record_wait(time.monotonic() - started)
+        self.running += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.running -= 1
+        self.semaphore.release()
+
+    def _record_wait(self, seconds: float) -> None:
+        self.acquired += 1
+        self.wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "waiting": self.waiting,
+            "running": self.running,
+            "mean_wait_seconds": round(self.wait_seconds / max(self.acquired, 1), 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+
+class Scheduler(Limit):
+    """Runs jobs one after another per chat and at most `size` at once overall.
+
+    A chat's jobs start in the order they were submitted. When `max_waiting`
+    jobs wait overall or `max_waiting_per_chat` in one chat, `job` raises Busy
+    instead of queueing another one. After `close`, jobs that haven't started
+    raise Draining.
+    """
+
+    def __init__(self, size: int, max_waiting: int, max_waiting_per_chat: int):
+        super().__init__(size)
+        self.max_waiting = max_waiting
+        self.max_waiting_per_chat = max_waiting_per_chat
+        self.chats: dict[int, asyncio.Lock] = {}
+        # waiting and running jobs per chat
+        self.chat_jobs = Counter()
+        self.shed = 0
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+    @asynccontextmanager
+    async def job(self, chat_id: int):
+        if self.closed:
+            raise Draining()
+        # one of the chat's jobs may be running, the others wait
+        chat_waiting = max(self.chat_jobs[chat_id] - 1, 0)
+        if (
+            self.waiting >= self.max_waiting
+            or chat_waiting >= self.max_waiting_per_chat
+        ):
+            self.shed += 1
+            raise Busy()
+
+        lock = self.chats.setdefault(chat_id, asyncio.Lock())
+        self.chat_jobs[chat_id] += 1
+        started = time.monotonic()
+        self.waiting += 1
+        waiting = True
+        try:
+            # asyncio locks wake waiters in order, so the chat's jobs keep theirs
+            async with lock:
+                await self.semaphore.acquire()
+                self.waiting -= 1
+                waiting = False
+                self._record_wait(time.monotonic() - started)
+                self.running += 1
+                try:
+                    if self.closed:
+                        # closed while it was waiting
+                        raise Draining()
+                    yield
+                finally:
+                    self.running -= 1
+                    self.semaphore.release()
+        finally:
+            if waiting:
+                # cancelled while waiting
+                self.waiting -= 1
+            self.chat_jobs[chat_id] -= 1
+            if self.chat_jobs[chat_id] == 0:
+                del self.chat_jobs[chat_id]
+                del self.chats[chat_id]
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "chats": len(self.chats),
+            "shed": self.shed,
+        }
+
+
+class ByteBudget:
+    """Bounds the bytes held by jobs at once, `reserve` waits until they fit.
+
+    A reservation larger than the whole budget is let through alone, so that
+    an oversized job runs instead of waiting forever.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(
+                    lambda: self.used == 0 or self.used + size <= self.limit
+                )
+            finally:
+                self.waiting -= 1
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "used": self.used, "waiting": self.waiting}
@@ -2,74 +2,215 @@
 
 # https://github.com/python-telegram-bot/python-telegram-bot/wiki/Extensions---Your-first-Bot
 
+import asyncio
+import atexit
 import json
 import logging
+import multiprocessing
 import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import asdict
-
-from db import load_db, save_db
-from google.api_core import client_options
-from google.cloud.speech_v2 import SpeechClient
-from google.cloud.speech_v2.types import cloud_speech
-from google.cloud.translate_v3.services.translation_service import (
-    TranslationServiceClient,
-)
-from migrations import ChatConfig, migrate
-from openai import OpenAI
-
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from pathlib import Path
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+from urllib.parse import urlparse
+
+import audio
+import metrics
+from batching import MicroBatcher
+from cache import TranscriptionCache, TranslationMemory, audio_hash
+from clients import Clients, import_providers
+from db import Store, db_dir
+from download import download_to_file, mapped
+from editing import MessageEditor
+from jobs import VoiceJob, VoiceJobs
+from lifecycle import FileLock, Health, HealthHandler
+from migrations import LANGUAGE_CODES, ChatConfig, load_database
+from numpy import ndarray
+from routing import Endpoint, Router
+from scheduler import Busy, ByteBudget, Draining, Limit, Scheduler
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ReactionEmoji
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
-openai_client = OpenAI()
+# imported in the background on startup, see start_providers
+if TYPE_CHECKING:
+    from google.cloud.speech_v2 import SpeechAsyncClient
+    from google.cloud.speech_v2.types import cloud_speech
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# JSON lines carrying the id of the update they belong to, see metrics.log
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(metrics.JsonFormatter())
+logging.basicConfig(handlers=[log_handler], level=logging.INFO)
 
 project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
 telegram_bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
-# https://cloud.google.com/speech-to-text/v2/docs/speech-to-text-supported-languages
-LANGUAGE_CODES = {"de-DE", "en-US", "uk-UA"}
-
-
-serialized_config = load_db("config")
-config = migrate(serialized_config)
-print(config)
+# e.g. http://localhost:8081 for a local Bot API server
+telegram_api_url = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+# with a webhook url, updates are pushed to us through Caddy instead of polled
+# https://core.telegram.org/bots/api#setwebhook
+telegram_webhook_url = os.environ.get("TELEGRAM_WEBHOOK_URL")
+telegram_webhook_secret = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+telegram_webhook_port = int(os.environ.get("TELEGRAM_WEBHOOK_PORT", "8443"))
+if telegram_webhook_url and not telegram_webhook_secret:
+    # without it anyone could post updates to the webhook through Caddy
+    raise SystemExit("TELEGRAM_WEBHOOK_URL is set but TELEGRAM_WEBHOOK_SECRET isn't")
+SPEECH_MODEL = "chirp"
+# chirp doesn't support StreamingRecognize, chirp_2 does
+# https://cloud.google.com/speech-to-text/v2/docs/chirp_2-model
+SPEECH_STREAMING_MODEL = "chirp_2"
+# shorter voice messages are recognized before a progressive edit would help
+STREAMING_MIN_SECONDS = int(os.environ.get("SPEECH_STREAMING_MIN_SECONDS", "10"))
+# StreamingRecognizeRequest.audio is limited to 25 KB
+STREAMING_CHUNK_BYTES = 16 * 1024
+# sync recognition is limited to 60 s, longer voice messages are split on pauses
+# and the segments recognized in parallel
+CHUNKED_MIN_SECONDS = int(os.environ.get("SPEECH_CHUNKED_MIN_SECONDS", "55"))
+CHUNK_MAX_SECONDS = 50
+CHUNK_CONCURRENCY = int(os.environ.get("SPEECH_CHUNK_CONCURRENCY", "8"))
+# voice messages are decoded, trimmed and normalized before upload
+AUDIO_PREPROCESSING = os.environ.get("AUDIO_PREPROCESSING", "on") != "off"
+# Telegram allows roughly one message edit per second and chat
+EDIT_INTERVAL = float(os.environ.get("TELEGRAM_EDIT_INTERVAL", "1.0"))
+# Prometheus metrics on http://127.0.0.1:<port>/metrics, 0 turns them off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+# a recognition slower than its region's p95 is raced by a backup request to
+# the next region in SPEECH_REGIONS
+SPEECH_HEDGING = os.environ.get("SPEECH_HEDGING", "on") != "off"
+# voice messages are processed one after another per chat and VOICE_CONCURRENCY
+# at once overall, further ones are turned away while the queues are full
+VOICE_CONCURRENCY = int(os.environ.get("VOICE_CONCURRENCY", "8"))
+VOICE_QUEUE = int(os.environ.get("VOICE_QUEUE", "64"))
+VOICE_QUEUE_PER_CHAT = int(os.environ.get("VOICE_QUEUE_PER_CHAT", "5"))
+# bytes of audio held in memory by all voice messages together, downloads wait
+# while it's used up
+AUDIO_MEMORY_BYTES = int(os.environ.get("AUDIO_MEMORY_BYTES", str(256 << 20)))
+# on SIGTERM, voice messages in processing get this long to finish, the rest is
+# resumed by the next instance; keep it below systemd's TimeoutStopSec
+DRAIN_SECONDS = float(os.environ.get("TELEGRAM_DRAIN_SECONDS", "30"))
+
+
+config = load_database(
+    Store("config"), float(os.environ.get("CONFIG_WRITE_DELAY", "1.0"))
+)
+# post_shutdown flushes on SIGTERM, this covers exits that skip it
+atexit.register(config.chats.persister.flush_sync)
+metrics.log("config", chats=repr(config.chats))
+
+# created in the background after startup, voice jobs await `providers` first
+clients: Clients = None
+speech_router: "Router[SpeechAsyncClient]" = None
+providers: asyncio.Task = None
+
+# commands don't pass the voice queue, so they are answered right away
+voice_jobs = Scheduler(VOICE_CONCURRENCY, VOICE_QUEUE, VOICE_QUEUE_PER_CHAT)
+# checkpoints of the voice messages in processing, to resume them after a restart
+voice_jobs_db = VoiceJobs(Store("jobs"))
+# resumed voice jobs and the warm-up, started before the application runs
+background_tasks = set()
+# voice jobs in processing by update id, including resumed ones
+running_jobs: dict[int, asyncio.Task] = {}
+
+# on a deploy the next instance starts before this one stops, see handoff.py;
+# only one may poll at a time, and only the last one resumes the voice jobs
+health = Health(db_dir.joinpath("handoff.json"))
+updates_lock = FileLock(db_dir.joinpath("updates.lock"))
+jobs_lock = FileLock(db_dir.joinpath("jobs.lock"))
+stopping = asyncio.Event()
+audio_memory = ByteBudget(AUDIO_MEMORY_BYTES)
+# requests in flight per provider, shared by all voice messages, to stay within
+# the quotas
+provider_limits = {
+    "speech": Limit(int(os.environ.get("SPEECH_CONCURRENCY", "16"))),
+    "translate": Limit(int(os.environ.get("TRANSLATE_CONCURRENCY", "8"))),
+    "openai": Limit(int(os.environ.get("OPENAI_CONCURRENCY", "4"))),
+}
+
+# forkserver, as forking the process with live gRPC channels isn't supported;
+# the workers fork from a server that has numpy imported already
+audio_context = multiprocessing.get_context("forkserver")
+audio_context.set_forkserver_preload(["audio"])
+audio_pool = ProcessPoolExecutor(max_workers=2, mp_context=audio_context)
+
+transcripts = TranscriptionCache(db_dir.joinpath("transcripts"))
+translations = TranslationMemory(
+    db_dir.joinpath("translations.sqlite"),
+    enabled=os.environ.get("TRANSLATION_MEMORY", "on") != "off",
+)
 
 
 # https://cloud.google.com/translate/docs/advanced/translate-text-advance
 # https://cloud.google.com/python/docs/reference/translate/latest/google.cloud.translate_v3.services.translation_service.TranslationServiceClient
-def google_translate_text(
-    text: str, project_id: str, source_language_code: str, target_language_code: str
-) -> str:
-    """Translating Text."""
-
-    client = TranslationServiceClient()
+async def google_translate_batch(
+    contents: list[str],
+    project_id: str,
+    source_language_code: str,
+    target_language_code: str,
+) -> list[str]:
+    """Translating a batch of texts in one request."""
 
     parent = f"projects/{project_id}"
 
-    # Translate text from English to French
     # Detail on supported types can be found here:
     # https://cloud.google.com/translate/docs/supported-formats
-    response = client.translate_text(
-        request={
-            "parent": parent,
-            "contents": [text],
-            "mime_type": "text/plain",  # mime types: text/plain, text/html
-            "source_language_code": source_language_code,
-            "target_language_code": target_language_code,
-        }
+    async with provider_limits["translate"], metrics.stage("translate", "google"):
+        response = await clients.translate.translate_text(
+            request={
+                "parent": parent,
+                "contents": contents,
+                "mime_type": "text/plain",  # mime types: text/plain, text/html
+                "source_language_code": source_language_code,
+                "target_language_code": target_language_code,
+            }
+        )
+
+    return [translation.translated_text for translation in response.translations]
+
+
+def item_error(error: Exception) -> bool:
+    """Errors a single text of a batch can cause, like one that is too long."""
+    from google.api_core import exceptions
+
+    return isinstance(error, exceptions.InvalidArgument)
+
+
+# concurrent translations for the same language pair share one request
+translate_batcher = MicroBatcher(
+    google_translate_batch,
+    window=float(os.environ.get("TRANSLATE_BATCH_WINDOW", "0.05")),
+    max_size=int(os.environ.get("TRANSLATE_BATCH_SIZE", "32")),
+    splittable=item_error,
+)
+
+
+async def google_translate_text(
+    text: str, project_id: str, source_language_code: str, target_language_code: str
+) -> str:
+    """Translating Text."""
+
+    translated = await translations.get(
+        text, source_language_code, target_language_code
     )
+    if translated is not None:
+        return translated
 
-    return response.translations[0].translated_text
+    translated = await translate_batcher.submit(
+        text, project_id, source_language_code, target_language_code
+    )
+    await translations.put(text, source_language_code, target_language_code, translated)
+    return translated
 
 
 # https://cloud.google.com/speech-to-text/v2/docs/chirp-model
@@ -77,34 +218,55 @@ async def google_speech_to_text(
     project_id: str,
     audio_data: bytes,
     language_codes: list[str] = ["de-DE"],
-) -> cloud_speech.RecognizeResponse:
-    """Transcribe an audio file."""
-    # regional endpoint for more features for uk-UA
-    # https://cloud.google.com/speech-to-text/docs/endpoints
-    _client_options = client_options.ClientOptions(
-        api_endpoint="europe-west4-speech.googleapis.com"
-    )
+    model: str = SPEECH_MODEL,
+    on_partial: Optional[Callable[[str], None]] = None,
+    pcm_sample_rate: Optional[int] = None,
+    seconds: float = 1.0,
+) -> str:
+    """Transcribe an audio file of `seconds` length.
 
-    # Instantiates a client
-    client = SpeechClient(client_options=_client_options)
+    With `on_partial`, the audio is streamed and `on_partial` receives the text
+    recognized so far, including interim results, whenever it changes.
+    With `pcm_sample_rate`, `audio_data` is raw 16-bit mono PCM.
+    The request goes to the regions in SPEECH_REGIONS, see speech_router.
+    """
+    from google.cloud.speech_v2.types import cloud_speech
 
     features = cloud_speech.RecognitionFeatures(enable_automatic_punctuation=True)
 
+    if pcm_sample_rate is None:
+        decoding = {"auto_decoding_config": cloud_speech.AutoDetectDecodingConfig()}
+    else:
+        decoding = {
+            "explicit_decoding_config": cloud_speech.ExplicitDecodingConfig(
+                encoding=cloud_speech.ExplicitDecodingConfig.AudioEncoding.LINEAR16,
+                sample_rate_hertz=pcm_sample_rate,
+                audio_channel_count=1,
+            )
+        }
     recognitionConfig = cloud_speech.RecognitionConfig(
-        auto_decoding_config=cloud_speech.AutoDetectDecodingConfig(),
+        **decoding,
         language_codes=language_codes,
-        model="chirp",
+        model=model,
         features=features,
     )
+    if on_partial is not None:
+        return await google_streaming_speech_to_text(
+            project_id, recognitionConfig, audio_data, on_partial, seconds
+        )
 
-    request = cloud_speech.RecognizeRequest(
-        recognizer=f"projects/{project_id}/locations/europe-west4/recognizers/_",
-        config=recognitionConfig,
-        content=audio_data,
-    )
+    async def recognize(endpoint: "Endpoint[SpeechAsyncClient]"):
+        request = cloud_speech.RecognizeRequest(
+            recognizer=recognizer(project_id, endpoint.name),
+            config=recognitionConfig,
+            content=audio_data,
+        )
+        async with metrics.stage("stt", endpoint.name):
+            return await endpoint.client.recognize(request=request)
 
     # Transcribes the audio into text
-    response = client.recognize(request=request)
+    async with provider_limits["speech"]:
+        response = await speech_router.call(recognize, units=seconds)
 
     # Concatenate the recognized text
     recognized_text = ""
@@ -114,10 +276,160 @@ async def google_speech_to_text(
     return recognized_text
 
 
+# https://cloud.google.com/speech-to-text/v2/docs/streaming-recognize
+async def google_streaming_speech_to_text(
+    project_id: str,
+    recognitionConfig: "cloud_speech.RecognitionConfig",
+    audio_data: bytes,
+    on_partial: Callable[[str], None],
+    seconds: float,
+) -> str:
+    from google.cloud.speech_v2.types import cloud_speech
+
+    streaming_config = cloud_speech.StreamingRecognitionConfig(
+        config=recognitionConfig,
+        streaming_features=cloud_speech.StreamingRecognitionFeatures(
+            interim_results=True
+        ),
+    )
+
+    async def requests(location: str):
+        yield cloud_speech.StreamingRecognizeRequest(
+            recognizer=recognizer(project_id, location),
+            streaming_config=streaming_config,
+        )
+        # stored audio, so no need to pace the chunks in real time
+        for offset in range(0, len(audio_data), STREAMING_CHUNK_BYTES):
+            yield cloud_speech.StreamingRecognizeRequest(
+                audio=audio_data[offset : offset + STREAMING_CHUNK_BYTES]
+            )
+
+    async def recognize(endpoint: "Endpoint[SpeechAsyncClient]") -> str:
+        recognized_text = ""
+        async with metrics.stage("stt_streaming", endpoint.name):
+            responses = await endpoint.client.streaming_recognize(
+                requests=requests(endpoint.name)
+            )
+            async for response in responses:
+                interim_text = ""
+                for result in response.results:
+                    if not result.alternatives:
+                        continue
+                    if result.is_final:
+                        recognized_text += result.alternatives[0].transcript + "\n"
+                    else:
+                        interim_text += result.alternatives[0].transcript
+                on_partial(recognized_text + interim_text)
+        return recognized_text
+
+    # two streams would mix their partial results, so a stream is only retried
+    async with provider_limits["speech"]:
+        return await speech_router.call(recognize, units=seconds, hedge=False)
+
+
+def recognizer(project_id: str, location: str) -> str:
+    return f"projects/{project_id}/locations/{location}/recognizers/_"
+
+
+def retryable(error: Exception) -> bool:
+    """Errors another attempt or region may not run into."""
+    from google.api_core import exceptions
+
+    return isinstance(
+        error,
+        (
+            exceptions.ServiceUnavailable,
+            exceptions.DeadlineExceeded,
+            exceptions.InternalServerError,
+            exceptions.TooManyRequests,
+            exceptions.Aborted,
+            exceptions.Unknown,
+        ),
+    )
+
+
+async def preprocess_audio(audio_file: Path) -> ndarray:
+    """Decode to 16 kHz mono and trim and normalize it in the process pool."""
+    samples = await audio.decode(audio_file)
+    if not AUDIO_PREPROCESSING:
+        return samples
+    return await asyncio.get_running_loop().run_in_executor(
+        audio_pool, audio.preprocess, samples
+    )
+
+
+async def google_chunked_speech_to_text(
+    project_id: str,
+    samples: ndarray,
+    language_codes: list[str],
+    on_partial: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Transcribe audio of any length by recognizing its segments in parallel.
+
+    `on_partial` receives the text of the leading segments that are done."""
+    segments = await asyncio.to_thread(
+        audio.split_on_silence, samples, CHUNK_MAX_SECONDS
+    )
+    semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+    texts = [None] * len(segments)
+
+    async def recognize(i: int, start: int, end: int):
+        async with semaphore:
+            texts[i] = await google_speech_to_text(
+                project_id=project_id,
+                audio_data=samples[start:end].tobytes(),
+                language_codes=language_codes,
+                pcm_sample_rate=audio.SAMPLE_RATE,
+                seconds=(end - start) / audio.SAMPLE_RATE,
+            )
+        if on_partial is not None:
+            done = []
+            for text in texts:
+                if text is None:
+                    break
+                done.append(text)
+            on_partial("".join(done))
+
+    await asyncio.gather(
+        *(recognize(i, *segment) for i, segment in enumerate(segments))
+    )
+    return "".join(texts)
+
+
+async def openai_suggest_answers(
+    transcribed: str,
+    from_language: str,
+    to_language: str,
+    on_partial: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Possible answers, `on_partial` receives the text as it is generated."""
+    async with provider_limits["openai"], metrics.stage("llm", "openai"):
+        stream = await clients.openai.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "system",
+                    "content": f"You are a teacher in the ${from_language} language and particiapte in a group chat between a native speaker and an immigrant who learns the language and culture. The trainer speaks voice messages in ${from_language} and you want to provide the learner with three possible answers to the trainer's message. You provide them in ${from_language} to provide translations and explanations in ${to_language}.",
+                },
+                {"role": "assistant", "content": transcribed},
+                {
+                    "role": "system",
+                    "content": "Provide the learner with possible answers to the trainer's message. Try to be short and concise.",
+                },
+            ],
+            stream=True,
+        )
+        text = ""
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                if on_partial is not None:
+                    on_partial(text)
+    return text
+
+
 def get_config(chat_id: int) -> ChatConfig:
-    if not chat_id in config.chats:
-        config.chats[chat_id] = ChatConfig()
-    return config.chats[chat_id]
+    return config.chats.get(chat_id)
 
 
 class ConfigureChat:
@@ -136,13 +448,16 @@ class ConfigureChat:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if exc_type is not None:
-            print(f"A{exc_type.__name__}: {exc_val}")
+            metrics.log("config_rejected", error=f"{exc_type.__name__}: {exc_val}")
             await self.update.message.set_reaction(ReactionEmoji.SHRUG)
         else:
-            save_db("config", asdict(config))
+            # the reaction confirms the change, it's written shortly after; await
+            # config.chats.persister.flush() where it must be on disk already
+            config.chats.save(self.update.effective_chat.id, self.chat)
             await self.update.message.set_reaction(ReactionEmoji.OK_HAND_SIGN)
 
 
+@metrics.timed("command_lang")
 async def lang_command(update: Update, context):
     async with ConfigureChat(update) as configure:
         if not configure.value in LANGUAGE_CODES:
@@ -150,6 +465,7 @@ async def lang_command(update: Update, context):
         configure.chat.trainer_language = configure.value
 
 
+@metrics.timed("command_otherlang")
 async def otherlang_command(update: Update, context):
     async with ConfigureChat(update) as configure:
         if not configure.value in LANGUAGE_CODES:
@@ -157,6 +473,7 @@ async def otherlang_command(update: Update, context):
         configure.chat.learner_language = configure.value
 
 
+@metrics.timed("command_suggestions")
 async def suggestions_command(update: Update, context):
     async with ConfigureChat(update) as configure:
         if configure.value == "on":
@@ -167,6 +484,7 @@ async def suggestions_command(update: Update, context):
             raise ValueError("Invalid value")
 
 
+@metrics.timed("command_config")
 async def config_command(update: Update, context):
     # show current config
     config = get_config(update.effective_chat.id)
@@ -178,6 +496,24 @@ async def config_command(update: Update, context):
     )
 
 
+@metrics.timed("command_status")
+async def status_command(update: Update, context):
+    # queue depths and waiting times of the voice messages and provider requests
+    status = {
+        "voice": voice_jobs.stats(),
+        "audio_memory": audio_memory.stats(),
+        "speech_regions": speech_router.stats() if speech_router else "starting",
+        "translate_batches": translate_batcher.stats(),
+        **{name: limit.stats() for name, limit in provider_limits.items()},
+    }
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"<blockquote>{json.dumps(status, indent=4)}</blockquote>",
+        parse_mode="HTML",
+    )
+
+
+@metrics.timed("command_translate")
 async def translate_command(update: Update, context):
     print("button pressed!")
     await context.bot.send_message(chat_id=update.effective_chat.id, text="...")
@@ -198,6 +534,7 @@ async def readout(update: Update, context):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="🔉...")
 
 
+@metrics.timed("command_help")
 async def help_command(update: Update, context):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -206,11 +543,32 @@ async def help_command(update: Update, context):
 /otherlang de-DE
 /suggestions on|off
 /config
+/status
 Languages: {" ".join(LANGUAGE_CODES)}
 """,
     )
 
 
+async def show_result(
+    editor: MessageEditor,
+    result: Awaitable[str],
+    placeholder: Optional[Callable[[], Awaitable[int]]] = None,
+) -> None:
+    """Replace a placeholder message with the result, or with ✘ if it failed.
+    Sends the placeholder first if the editor has no message yet."""
+    try:
+        if editor.message_id is None:
+            editor.attach(await placeholder())
+        await editor.close(await result)
+    except Exception as e:
+        metrics.log("stage_failed", error=repr(e))
+        if editor.message_id is not None:
+            try:
+                await editor.fail()
+            except Exception as e:
+                metrics.log("stage_failed", error=repr(e))
+
+
 def render_button(text: str, data: str):
     keyboard = [[InlineKeyboardButton(text, callback_data=data)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -219,91 +577,230 @@ def render_button(text: str, data: str):
 
 # transcribe
 async def transcribe_and_translate(update: Update, context: CallbackContext):
-    print("voice")
+    metrics.log("voice", chat=update.effective_chat.id)
+    # the languages as configured when the voice message arrived
     chat_config = get_config(update.effective_chat.id)
     is_trainer = update.message.from_user.id == chat_config.trainer_id
-    from_language = (
-        chat_config.trainer_language if is_trainer else chat_config.learner_language
-    )
-    to_language = (
-        chat_config.learner_language if is_trainer else chat_config.trainer_language
-    )
-    bot_message = await context.bot.send_message(
-        chat_id=update.effective_chat.id, text="🎙..."
+    job = VoiceJob(
+        update_id=update.update_id,
+        chat_id=update.effective_chat.id,
+        file_id=update.message.voice.file_id,
+        file_unique_id=update.message.voice.file_unique_id,
+        duration=update.message.voice.duration,
+        from_language=(
+            chat_config.trainer_language if is_trainer else chat_config.learner_language
+        ),
+        to_language=(
+            chat_config.learner_language if is_trainer else chat_config.trainer_language
+        ),
+        # provide the learner with possible answers to the trainer's message
+        suggesting=chat_config.suggestions and is_trainer,
     )
-    try:
-        # get audio
-        voice = await update.message.voice.get_file()
-        voice_data: bytearray = await voice.download_as_bytearray()
+    if not await voice_jobs_db.create(job):
+        metrics.log("duplicate_update")
+        return
+    await run_voice_job(context.bot, job)
 
-        # transcribe
-        voice_language = from_language
-        transcribed = await google_speech_to_text(
-            project_id=project_id,
-            audio_data=bytes(voice_data),
-            language_codes=[voice_language],
-        )
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=bot_message.message_id,
-            text=f"<blockquote>{transcribed}</blockquote>",
-            parse_mode="HTML",
-        )
 
-        # translate
-        bot_message = await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="文A ..."
-        )
-        translated = google_translate_text(
-            transcribed,
-            project_id,
-            from_language,
-            to_language,
+async def run_voice_job(bot: Bot, job: VoiceJob):
+    # resumed jobs run outside of an update
+    metrics.correlation_id.set(str(job.update_id))
+    running_jobs[job.update_id] = asyncio.current_task()
+    try:
+        async with voice_jobs.job(job.chat_id):
+            await process_voice(bot, job)
+    except Busy:
+        metrics.log("busy", chat=job.chat_id)
+        await bot.send_message(chat_id=job.chat_id, text="✘ busy, try again later")
+    except Draining:
+        # stays unfinished, the next instance resumes it
+        metrics.log("deferred", chat=job.chat_id)
+        return
+    finally:
+        running_jobs.pop(job.update_id, None)
+    await voice_jobs_db.finish(job)
+
+
+async def process_voice(bot: Bot, job: VoiceJob):
+    """Run the stages of a voice job that have no checkpoint yet."""
+    chat_id = job.chat_id
+    if job.transcript_message_id is None:
+        bot_message = await bot.send_message(chat_id=chat_id, text="🎙...")
+        job.transcript_message_id = bot_message.message_id
+        await voice_jobs_db.save(job)
+    transcript_editor = MessageEditor(
+        bot, chat_id, job.transcript_message_id, interval=EDIT_INTERVAL
+    )
+    try:
+        # the placeholder is out, the first voice messages after a start may
+        # still wait for the clients
+        await providers
+        if job.transcript is None:
+            job.transcript = await transcribe(bot, job, transcript_editor)
+            await voice_jobs_db.save(job)
+    except Exception as e:
+        metrics.log("voice_failed", error=repr(e))
+        await transcript_editor.fail()
+        return
+    transcribed = job.transcript
+
+    def placeholder(field: str, text: str) -> Callable[[], Awaitable[int]]:
+        async def send() -> int:
+            message = await bot.send_message(chat_id=chat_id, text=text)
+            setattr(job, field, message.message_id)
+            await voice_jobs_db.save(job)
+            return message.message_id
+
+        return send
+
+    # the translation and the suggestions only depend on the transcript, so
+    # they run alongside each other and the Telegram messages showing them;
+    # each stage shows its own failure, the transcript stays
+    tasks = []
+    try:
+        translation = asyncio.create_task(
+            voice_jobs_db.stage(
+                job,
+                "translation",
+                lambda: google_translate_text(
+                    transcribed, project_id, job.from_language, job.to_language
+                ),
+            )
         )
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=bot_message.message_id,
-            text=f"<blockquote>{translated}</blockquote>",
-            parse_mode="HTML",
+        tasks.append(translation)
+        translate_editor = MessageEditor(
+            bot, chat_id, job.translate_message_id, interval=EDIT_INTERVAL
         )
-
-        # provide the learner with possible answers to the trainer's message
-        if chat_config.suggestions and is_trainer:
-            bot_message = await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="✏️...",
+        stages = [
+            transcript_editor.close(transcribed),
+            show_result(
+                translate_editor,
+                translation,
+                placeholder("translate_message_id", "文A ..."),
+            ),
+        ]
+        if job.suggesting:
+            # streamed into the message as they are generated
+            suggest_editor = MessageEditor(
+                bot, chat_id, job.suggest_message_id, interval=EDIT_INTERVAL
+            )
+            suggestion = asyncio.create_task(
+                voice_jobs_db.stage(
+                    job,
+                    "suggestion",
+                    lambda: openai_suggest_answers(
+                        transcribed,
+                        job.from_language,
+                        job.to_language,
+                        on_partial=suggest_editor.update,
+                    ),
+                )
             )
-            completion = openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"You are a teacher in the ${from_language} language and particiapte in a group chat between a native speaker and an immigrant who learns the language and culture. The trainer speaks voice messages in ${from_language} and you want to provide the learner with three possible answers to the trainer's message. You provide them in ${from_language} to provide translations and explanations in ${to_language}.",
-                    },
-                    {"role": "assistant", "content": transcribed},
-                    {
-                        "role": "system",
-                        "content": "Provide the learner with possible answers to the trainer's message. Try to be short and concise.",
-                    },
-                ],
+            tasks.append(suggestion)
+            stages.append(
+                show_result(
+                    suggest_editor,
+                    suggestion,
+                    placeholder("suggest_message_id", "✏️..."),
+                )
             )
-            suggestions = completion.choices[0].message.content
-
-            # print(completion.choices[0].message)
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=bot_message.message_id,
-                text=f"<blockquote>{suggestions}</blockquote>",
-                parse_mode="HTML",
+        for result in await asyncio.gather(*stages, return_exceptions=True):
+            if isinstance(result, Exception):
+                metrics.log("stage_failed", error=repr(result))
+    finally:
+        # a stage whose message couldn't be sent leaves its task behind
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def transcribe(bot: Bot, job: VoiceJob, transcript_editor: MessageEditor) -> str:
+    # long voice messages are streamed or split, showing the text as it is
+    # recognized
+    duration = job.duration
+    chunked = duration >= CHUNKED_MIN_SECONDS
+    streaming = not chunked and duration >= STREAMING_MIN_SECONDS
+    model = SPEECH_STREAMING_MODEL if streaming else SPEECH_MODEL
+
+    # forwarded voice messages keep their file_unique_id, re-uploaded ones
+    # at least their content
+    voice_language = job.from_language
+    cache_key = transcripts.key(job.file_unique_id, [voice_language], model)
+    transcribed = await transcripts.get(cache_key)
+    if transcribed is not None:
+        return transcribed
+
+    # get audio, kept until the job is finished
+    if job.audio_path is None:
+        voice = await bot.get_file(job.file_id)
+        file_bytes = voice.file_size or 0
+    else:
+        voice = None
+        file_bytes = Path(job.audio_path).stat().st_size
+    # the decoded samples, and their copy in the audio process
+    pcm_bytes = job.duration * audio.SAMPLE_RATE * 2
+    async with audio_memory.reserve(file_bytes + 2 * pcm_bytes):
+        if voice is not None:
+            path = voice_jobs_db.audio_path(job)
+            async with metrics.stage("telegram_download", "telegram"):
+                size = await download_to_file(clients.http, voice.file_path, path)
+            metrics.audio_bytes.inc("downloaded", amount=size)
+            job.audio_path = str(path)
+            await voice_jobs_db.save(job)
+        audio_file = Path(job.audio_path)
+        with mapped(audio_file) as audio_data:
+            download_bytes = len(audio_data)
+            content_key = transcripts.key(
+                audio_hash(audio_data), [voice_language], model
             )
+            transcribed = await transcripts.get(content_key)
+            # the original upload needs its own bytes for the request
+            upload = None if chunked or AUDIO_PREPROCESSING else bytes(audio_data)
 
-    except Exception as e:
-        print(e)
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=bot_message.message_id,
-            text="✘",
-        )
+        # transcribe
+        if transcribed is None:
+            started = time.perf_counter()
+            seconds = duration
+            if chunked or AUDIO_PREPROCESSING:
+                async with metrics.stage("preprocess", "ffmpeg"):
+                    samples = await preprocess_audio(audio_file)
+                    seconds = len(samples) / audio.SAMPLE_RATE
+                    if not chunked:
+                        upload = await audio.encode(samples)
+            upload_bytes = samples.nbytes if chunked else len(upload)
+            metrics.audio_bytes.inc("uploaded", amount=upload_bytes)
+            metrics.audio_seconds.inc("received", amount=duration)
+            metrics.audio_seconds.inc("recognized", amount=seconds)
+            preprocessed = time.perf_counter()
+
+            if chunked:
+                transcribed = await google_chunked_speech_to_text(
+                    project_id=project_id,
+                    samples=samples,
+                    language_codes=[voice_language],
+                    on_partial=transcript_editor.update,
+                )
+            else:
+                transcribed = await google_speech_to_text(
+                    project_id=project_id,
+                    audio_data=upload,
+                    language_codes=[voice_language],
+                    model=model,
+                    on_partial=transcript_editor.update if streaming else None,
+                    seconds=seconds,
+                )
+            metrics.log(
+                "audio",
+                download_bytes=download_bytes,
+                upload_bytes=upload_bytes,
+                duration=duration,
+                seconds=round(seconds, 1),
+                preprocessing=round(preprocessed - started, 4),
+                recognition=round(time.perf_counter() - preprocessed, 4),
+            )
+            await transcripts.put(content_key, transcribed)
+    await transcripts.put(cache_key, transcribed)
+    return transcribed
 
 
 async def button(update: Update, context: CallbackContext):
@@ -318,6 +815,225 @@ async def button(update: Update, context: CallbackContext):
         await query.answer()
 
 
+async def track_update(update: Update, context: CallbackContext):
+    """Tag what the update causes with its id, and count it by kind."""
+    metrics.correlation_id.set(str(update.update_id))
+    if update.message and update.message.voice:
+        kind = "voice"
+    elif update.message and (update.message.text or "").startswith("/"):
+        kind = "command"
+    elif update.callback_query:
+        kind = "callback"
+    else:
+        kind = "other"
+    metrics.updates.inc(kind)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Times the Bot API calls by method, e.g. sendMessage or editMessageText."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        async with metrics.stage(api_method, "telegram"):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        if code >= 400:
+            metrics.stage_errors.inc(api_method, "telegram", str(code))
+        return code, payload
+
+
+def queue_metrics() -> list[metrics.Metric]:
+    jobs = metrics.Gauge(
+        "bot_queue_jobs", "Jobs waiting for and holding a slot.", ("queue", "state")
+    )
+    wait = metrics.Counter(
+        "bot_queue_wait_seconds_total", "Time jobs waited for a slot.", ("queue",)
+    )
+    started = metrics.Counter(
+        "bot_queue_started_total", "Jobs that got a slot.", ("queue",)
+    )
+    for name, limit in {"voice": voice_jobs, **provider_limits}.items():
+        jobs.set(name, "waiting", value=limit.waiting)
+        jobs.set(name, "running", value=limit.running)
+        wait.inc(name, amount=limit.wait_seconds)
+        started.inc(name, amount=limit.acquired)
+    shed = metrics.Counter(
+        "bot_voice_shed_total", "Voice messages turned away as busy."
+    )
+    shed.inc(amount=voice_jobs.shed)
+    memory = metrics.Gauge(
+        "bot_audio_memory_bytes", "Audio bytes reserved by voice messages.", ("state",)
+    )
+    memory.set("used", value=audio_memory.used)
+    memory.set("limit", value=audio_memory.limit)
+    return [jobs, wait, started, shed, memory]
+
+
+def cache_metrics() -> list[metrics.Metric]:
+    lookups = metrics.Counter(
+        "bot_translation_memory_lookups_total",
+        "Lookups of short texts in the translation memory.",
+        ("result",),
+    )
+    lookups.inc("hit", amount=translations.hits)
+    lookups.inc("miss", amount=translations.misses)
+    return [lookups]
+
+
+def batch_metrics() -> list[metrics.Metric]:
+    batches = metrics.Counter(
+        "bot_batch_calls_total", "Batch calls by number of items.", ("batcher", "size")
+    )
+    items = metrics.Counter(
+        "bot_batch_items_total", "Items sent in batch calls.", ("batcher",)
+    )
+    wait = metrics.Counter(
+        "bot_batch_wait_seconds_total",
+        "Time items waited for their batch to be sent.",
+        ("batcher",),
+    )
+    for name, batcher in {"translate": translate_batcher}.items():
+        for size, count in batcher.batch_sizes.items():
+            batches.inc(name, str(size), amount=count)
+        items.inc(name, amount=batcher.items)
+        wait.inc(name, amount=batcher.wait_seconds)
+    return [batches, items, wait]
+
+
+metrics.collectors.append(queue_metrics)
+metrics.collectors.append(batch_metrics)
+metrics.collectors.append(cache_metrics)
+metrics_server = None
+
+
+async def start_providers() -> None:
+    """Import the provider SDKs in a thread and create the clients.
+
+    Runs alongside polling, so that a restart answers commands right away.
+    """
+    global clients, speech_router
+    async with metrics.stage("import", "providers"):
+        credentials = await asyncio.to_thread(import_providers)
+    clients = Clients.create(credentials)
+    speech_router = Router(
+        [Endpoint(location, client) for location, client in clients.speech.items()],
+        retryable=retryable,
+        hedging=SPEECH_HEDGING,
+    )
+
+
+async def warm_up() -> None:
+    """Connect the clients and start the audio pool ahead of the first voice
+    message. The clients are usable meanwhile, requests wait for connections."""
+    try:
+        await providers
+    except Exception:
+        # logged by its stage, the voice jobs report it
+        return
+
+    async def start_audio_pool():
+        # starts the forkserver and a worker
+        async with metrics.stage("warm_up", "audio_pool"):
+            await asyncio.get_running_loop().run_in_executor(audio_pool, int)
+
+    await asyncio.gather(clients.warm_up(telegram_api_url), start_audio_pool())
+
+
+def run_in_background(coroutine: Awaitable) -> asyncio.Task:
+    # the application isn't running yet in post_init, so it wouldn't track the
+    # tasks; this keeps a reference until they are done
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def resume_jobs(bot: Bot) -> None:
+    """Continue the voice messages interrupted by the last shutdown or crash in
+    their messages, skipping the stages they finished.
+
+    Waits until the previous instance has exited, it may still be finishing
+    some of them.
+    """
+    if not await jobs_lock.acquire(until=stopping):
+        return
+    for job in voice_jobs_db.unfinished():
+        if job.update_id not in running_jobs:
+            metrics.log("resume", update=job.update_id, chat=job.chat_id)
+            run_in_background(run_voice_job(bot, job))
+
+
+async def start_serving(application: Application) -> None:
+    # the updater starts after post_init, then the application
+    while not application.running:
+        if stopping.is_set():
+            return
+        await asyncio.sleep(0.01)
+    health.serve()
+    metrics.log("serving", handoff_gap=health.measure_gap())
+
+
+async def drain(application: Application) -> None:
+    """Stop taking updates, give the voice jobs in processing DRAIN_SECONDS and
+    leave the others to the next instance, then stop the application.
+
+    Replaces the application's own handling of SIGTERM, which would wait for all
+    queued voice messages, however long that takes.
+    """
+    if stopping.is_set():
+        return
+    stopping.set()
+    metrics.log("drain", running=len(running_jobs))
+    if application.updater.running:
+        await application.updater.stop()
+    health.stop_serving()
+    updates_lock.release()
+    # voice messages that are still waiting stay in voice_jobs_db
+    voice_jobs.close()
+    if running_jobs:
+        done, left = await asyncio.wait(
+            list(running_jobs.values()), timeout=DRAIN_SECONDS
+        )
+        for task in left:
+            task.cancel()
+        if left:
+            await asyncio.wait(left)
+        metrics.log("drained", finished=len(done), left=len(left))
+    application.stop_running()
+
+
+async def post_init(application: Application):
+    global metrics_server, providers
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: run_in_background(drain(application)))
+    if METRICS_PORT:
+        metrics_server = metrics.serve(
+            METRICS_PORT, handlers=[("/healthz", HealthHandler, {"health": health})]
+        )
+    providers = asyncio.create_task(start_providers())
+    run_in_background(warm_up())
+    run_in_background(resume_jobs(application.bot))
+    if not telegram_webhook_url:
+        # the previous instance polls until it drains; webhook updates go to
+        # whichever instance listens, see the Caddyfile
+        health.state = "standby"
+        if not await updates_lock.acquire(until=stopping):
+            # stopped in standby, before taking any updates
+            application.stop_running()
+            return
+    run_in_background(start_serving(application))
+
+
+async def post_shutdown(application: Application):
+    # run_polling stops on SIGTERM before calling this
+    await config.chats.persister.flush()
+    providers.cancel()
+    if clients is not None:
+        await clients.close()
+    if metrics_server is not None:
+        metrics_server.stop()
+
+
 if __name__ == "__main__":
     print("Starting bot...")
 
@@ -351,22 +1067,46 @@ if __name__ == "__main__":
     # exit()
 
     application = (
-        ApplicationBuilder().token(telegram_bot_token).concurrent_updates(True).build()
+        ApplicationBuilder()
+        .token(telegram_bot_token)
+        # the size ApplicationBuilder gives its own request
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .base_url(f"{telegram_api_url}/bot")
+        .base_file_url(f"{telegram_api_url}/file/bot")
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
     )
 
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
     application.add_handler(CommandHandler("translate", translate_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("lang", lang_command))
     application.add_handler(CommandHandler("otherlang", otherlang_command))
     application.add_handler(CommandHandler("suggestions", suggestions_command))
     application.add_handler(CommandHandler("config", config_command))
+    application.add_handler(CommandHandler("status", status_command))
 
     application.add_handler(CallbackQueryHandler(button))
 
     voice_handler = MessageHandler(filters.VOICE, transcribe_and_translate, block=False)
     application.add_handler(voice_handler)
 
-    application.run_polling()
+    if telegram_webhook_url:
+        # sets the webhook on start, requests without the secret are rejected;
+        # the secret is required above
+        application.run_webhook(
+            listen="127.0.0.1",
+            port=telegram_webhook_port,
+            url_path=urlparse(telegram_webhook_url).path.lstrip("/"),
+            webhook_url=telegram_webhook_url,
+            secret_token=telegram_webhook_secret,
+            # see drain
+            stop_signals=None,
+        )
+    else:
+        application.run_polling(stop_signals=None)
 
 # fotos übersetzen
 # test
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Checks hookrunner.py against a file-based remote, a bare repository in a
+# temporary directory: a burst of concurrent runs with a push in between ends
+# in one update that includes that push, a push during an update gets an update
+# of its own, and a local change that the update would overwrite fails the run
+# with exit code 1.
+#
+#   python webhook/check_hookrunner.py
+
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+RUNNER = Path(__file__).with_name("hookrunner.py")
+DEBOUNCE = 0.5
+
+
+def git(cwd: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=check", "-c", "user.email=check@localhost", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+
+
+def push(work: Path, message: str, file: str = "", text: str = "") -> str:
+    if file:
+        work.joinpath(file).write_text(text)
+        git(work, "add", file)
+    git(work, "commit", "--allow-empty", "-m", message)
+    git(work, "push", "-q", "origin", "main")
+    return git(work, "rev-parse", "HEAD")
+
+
+def start(checkout: Path) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, str(RUNNER), str(checkout), f"--debounce={DEBOUNCE}"],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def updates(checkout: Path) -> list[dict]:
+    log = checkout / ".git" / "hookrunner.log"
+    return [json.loads(line) for line in log.read_text().splitlines()]
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, work, checkout = (Path(tmp) / name for name in ("remote", "w", "c"))
+        git(Path(tmp), "init", "-q", "--bare", "-b", "main", str(remote))
+        git(Path(tmp), "clone", "-q", str(remote), str(work))
+        push(work, "first")
+        git(Path(tmp), "clone", "-q", str(remote), str(checkout))
+
+        # a burst, with a push while the runs wait for the rest of it
+        push(work, "second")
+        runs = [start(checkout) for _ in range(10)]
+        time.sleep(DEBOUNCE / 4)
+        head = push(work, "third")
+        assert all(run.wait(30) == 0 for run in runs)
+        log = updates(checkout)
+        assert len(log) == 1, log
+        assert log[0]["pushes"] == 10 and log[0]["commit"] == head, log
+        print(f"burst of 10 runs: 1 update in {log[0]['seconds'] * 1000:.0f} ms")
+
+        # a push while the lock is held gets an update after the first
+        first = start(checkout)
+        time.sleep(DEBOUNCE * 1.2)
+        head = push(work, "fourth")
+        second = start(checkout)
+        assert first.wait(30) == 0 and second.wait(30) == 0
+        log = updates(checkout)[1:]
+        assert len(log) == 2 and log[-1]["commit"] == head, log
+        assert git(checkout, "rev-parse", "HEAD") == head
+        print("push during an update: a second update at the push")
+
+        # a local change the update would overwrite
+        push(work, "fifth", "page.txt", "a\n")
+        assert start(checkout).wait(30) == 0
+        checkout.joinpath("page.txt").write_text("changed on the server\n")
+        push(work, "sixth", "page.txt", "b\n")
+        run = start(checkout)
+        assert run.wait(30) == 1, run.stderr.read()
+        assert updates(checkout)[-1]["event"] == "update_failed"
+        assert checkout.joinpath("page.txt").read_text() == "changed on the server\n"
+        print("conflicting local change: exit 1, kept")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Updates a git checkout for a push webhook. webhook answers right away and
+# runs this in the background, once per push: a run notes that an update is
+# pending and only the run holding the repository's lock updates, as long as
+# updates are pending, so a burst of pushes ends in one or two updates instead
+# of overlapping pulls. The update fetches only the branch's last commit.
+# Each update is logged as a JSON line to .git/hookrunner.log.
+#
+#   python hookrunner.py /home/adabru/pocozy_homepage
+#
+# https://github.com/adnanh/webhook/blob/master/docs/Hook-Definition.md
+
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def log(path: Path, event: str, **fields) -> None:
+    with open(path, "a") as f:
+        f.write(json.dumps({"time": time.time(), "event": event, **fields}) + "\n")
+
+
+def note_pending(path: Path) -> None:
+    with open(path, "a") as f:
+        # not between reading and emptying it in take_pending
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(f"{time.time()}\n")
+
+
+def take_pending(path: Path) -> list[float]:
+    """The times of the pushes noted since the last update, emptied."""
+    with open(path, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        times = [float(line) for line in f if line.strip()]
+        f.truncate(0)
+    return times
+
+
+def update(repo: Path, branch: Optional[str], remote: str) -> dict:
+    """Fetches the branch's last commit and checks it out, keeping local
+    changes unless they'd be overwritten, then it fails like git pull."""
+    branch = branch or git(repo, "rev-parse", "--abbrev-ref", "HEAD")
+    started = time.monotonic()
+    git(repo, "fetch", "--depth=1", "--no-tags", remote, branch)
+    fetched = time.monotonic()
+    before = git(repo, "rev-parse", "HEAD")
+    git(repo, "reset", "--keep", "FETCH_HEAD")
+    after = git(repo, "rev-parse", "HEAD")
+    return {
+        "fetch_seconds": fetched - started,
+        "checkout_seconds": time.monotonic() - fetched,
+        "changed": before != after,
+        "commit": after,
+    }
+
+
+def run(repo: Path, branch: Optional[str], remote: str, debounce: float) -> int:
+    git_dir = repo / git(repo, "rev-parse", "--git-dir")
+    pending = git_dir / "hookrunner.pending"
+    log_path = git_dir / "hookrunner.log"
+    note_pending(pending)
+    failed = False
+    with open(git_dir / "hookrunner.lock", "a") as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # the run holding the lock updates for this push as well
+                return int(failed)
+            try:
+                while True:
+                    # the rest of a burst waits for the same update
+                    time.sleep(debounce)
+                    pushes = take_pending(pending)
+                    if not pushes:
+                        break
+                    started = time.monotonic()
+                    try:
+                        result = update(repo, branch, remote)
+                        log(
+                            log_path,
+                            "update",
+                            pushes=len(pushes),
+                            waited_seconds=time.time() - min(pushes),
+                            seconds=time.monotonic() - started,
+                            **result,
+                        )
+                    except subprocess.CalledProcessError as e:
+                        failed = True
+                        log(
+                            log_path,
+                            "update_failed",
+                            pushes=len(pushes),
+                            seconds=time.monotonic() - started,
+                            error=e.stderr.strip(),
+                        )
+                        print(e.stderr, file=sys.stderr)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            # a push noted after the last check whose run didn't get the lock
+            if not os.path.getsize(pending):
+                return int(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repo", type=Path)
+    parser.add_argument("--branch", help="the checked out one by default")
+    parser.add_argument("--remote", default="origin")
+    parser.add_argument(
+        "--debounce", type=float, default=1.0, help="seconds to wait for more pushes"
+    )
+    args = parser.parse_args()
+    sys.exit(run(args.repo, args.branch, args.remote, args.debounce))